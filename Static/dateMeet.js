@@ -34,10 +34,31 @@ async function retrieveBusinessInfo(evt){
 
     const $userInterest = $('#interest').val();
 
-    resp = await axios.post(`/dateMeet/api/yelp-business-search`,
-                            {
-                                'interest': $userInterest
-                            });
+    // Several interests separated by commas ("dinner, drinks, dessert") are searched 
+    // together in one request to the fan-out endpoint.
+    const interests = $userInterest.split(',').map(interest => interest.trim()).filter(interest => interest)
+
+    try {
+        if (interests.length > 1){
+            resp = await axios.post(`/dateMeet/api/yelp-business-search/multi`,
+                                    {
+                                        'interests': interests
+                                    });
+        }
+        else{
+            resp = await axios.post(`/dateMeet/api/yelp-business-search`,
+                                    {
+                                        'interest': $userInterest
+                                    });
+        }
+    }
+    catch (err) {
+        // The back end answers with a 503 and an error message when Yelp is unavailable.
+        $("#business_display").empty()
+        let message = err.response && err.response.data.error ? err.response.data.error : "Something went wrong, please try again."
+        $("#business_display").append($(`<h3 class="text-center">${message}</h3>`))
+        return
+    }
 
   console.log(resp.data)
 
@@ -65,5 +86,27 @@ async function retrieveBusinessInfo(evt){
 $("#interestform").on("submit", retrieveBusinessInfo)
 
 
+async function toggleLike(evt){
+    // This function likes or unlikes a recommendation through the JSON endpoint 
+    // and updates the button in place instead of reloading the whole feed.
 
+    evt.preventDefault();
+
+    const $form = $(evt.currentTarget);
+    const $button = $form.find('button');
+
+    try {
+        resp = await axios.post(`/dateMeet/api/recommendations/${$form.data('recommendation-id')}/like`);
+    }
+    catch (err) {
+        // Fall back to the regular form post if the JSON endpoint fails.
+        evt.currentTarget.submit();
+        return
+    }
+
+    $button.toggleClass('btn-primary', resp.data['liked']);
+    $button.toggleClass('btn-secondary', !resp.data['liked']);
+    $button.find('.like-count').text(resp.data['count']);
+}
 
+$(".like-form").on("submit", toggleLike)
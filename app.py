@@ -2,63 +2,167 @@
 
 import os 
 
-from flask import Flask, send_from_directory, render_template, request, flash, redirect, session, g, abort, jsonify 
+import click
+from flask import Flask, Blueprint, current_app, render_template, request, flash, redirect, session, g, abort, jsonify 
+from flask.cli import with_appcontext
 from flask_bootstrap import Bootstrap
-from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError 
 
 from forms import UserRegisterForm, UserEditForm, UserLoginForm, UserLocationForm, EditUserLocationForm, UserRecommendationAddForm, UserRecommendationEditForm
-from models import db, connect_db, User, Recommendation, Location, Likes, Follows
-from helpers import get_lat_lng, yelp_business_search
-from secrets import YELP_API_SECRET_KEY, GEOCODE_API_KEY
+from models import db, connect_db, User, Recommendation, Location, Likes, Follows, TimelineEntry, TrendingRecommendation
+from http_client import ProviderUnavailable, provider_stats
+from pagination import keyset_page, InvalidCursor
+from query_stats import init_query_recorder
+from lazy_globals import LazyGlobals
+from passwords import init_passwords
+from fragment_cache import init_fragment_cache, fragment_cache_stats
+from http_caching import init_http_caching, etag_for, conditional_render
+from assets import init_assets
+from compression import init_compression, compression_stats
+from images import init_images, image_cache_stats
+from cache import LRUCache
+from helpers import cached_get_lat_lng, geocode_cache_stats, cached_yelp_business_search, yelp_multi_business_search, yelp_cache_stats, MAX_FANOUT_PAGES
+from config import CONFIGS, load_api_keys
 
 CURR_USER_KEY = "curr_user"
 CURR_LOCATION = "None"
+# The id of the user whose latest location was already looked up (and not found) this session.
+LOCATION_CHECKED_KEY = "location_checked"
+MAX_NEARBY_RADIUS_KM = 100
+FEED_PAGE_SIZE = 100
+PROFILE_PAGE_SIZE = 50
+USERS_PAGE_SIZE = 60
+SEARCH_PAGE_SIZE = 20
+SOCIAL_PAGE_SIZE = 50
+TYPEAHEAD_LIMIT = 10
 
-app = Flask(__name__)
+bp = Blueprint('main', __name__)
 
-@app.route("/static/<path:path>")
-def static_dir(path):
-    return send_from_directory("static", path)
+current_user_cache = LRUCache(max_size=1024)
 
+####################################################################################################
+# User register/login/logout 
 
-Bootstrap(app)
+# g.user and g.location are loaded the first time a request reads them (see lazy_globals.py),
+# so static files and JSON endpoints that don't need them skip these queries.
 
-# For production and testing we need to get the DB_URI from environ variable 
-# If not DB_URI not yet set in environ variable, we use the development local db.
+@bp.before_app_request
+def reset_identity():
+    """Forget the user and location loaded by a previous request in the same app context."""
 
-app.config['SQLALCHEMY_DATABASE_URI'] = (os.environ.get('DATABASE_URL', 'postgres:///dateMeet'))
+    g.reset()
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "dateMeetisgr8")
-toolbar = DebugToolbarExtension(app)
+@LazyGlobals.loader('user')
+def load_user():
+    """If a user is logged in, load curr user for the Flask global."""
 
-connect_db(app)
+    if CURR_USER_KEY not in session:
+        return None
 
-####################################################################################################
-# User register/login/logout 
+    user_id = session[CURR_USER_KEY]
+    ttl = current_app.config['CURRENT_USER_CACHE_TTL']
 
-@app.before_request
-def add_user_to_g():
-    """If a user is logged in, add curr user to Flask global."""
+    if not ttl:
+        return User.query.get(user_id)
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    snapshot = current_user_cache.get(user_id)
+    if snapshot is not None:
+        return User.from_snapshot(snapshot)
 
-    else:
-        g.user = None
+    user = User.query.get(user_id)
+    if user is not None:
+        current_user_cache.set(user_id, user.snapshot(), ttl)
+
+    return user
+
+@LazyGlobals.loader('location')
+def load_user_location():
+    """If a user is logged in and has entered a location, load that location for the Flask global"""
+
+    if g.user and CURR_LOCATION in session:
+        return Location.query.get(session[CURR_LOCATION])
+
+    return None
+
+def set_current_location(user, location_id):
+    """This function saves `location_id` as the current location of `user` and commits."""
+
+    if location_id is None:
+        return
+
+    user.current_location_id = location_id
+    db.session.commit()
+    forget_cached_user(user.id)
+
+def forget_cached_user(user_id):
+    """This function removes a user from the current user cache after their row changes."""
+
+    current_user_cache.delete(user_id)
 
-@app.before_request
-def add_user_location():
-    """If a is logged in and has entered a location, save that location to Flask global"""
+def resolve_follow_state(users):
+    """This function loads whether the logged in user follows each of `users`, in one query.
+
+       Results are memoized for the rest of the request in `g.follow_state`, a dict of
+       user id -> bool, so templates can check them with `current_user_follows(user)`.
+    """
+
+    follow_state = g.setdefault('follow_state', {})
 
     if g.user:
-        if CURR_LOCATION in session:
-            g.location = Location.query.get(session[CURR_LOCATION])
-        else:
-            g.location = None
+        missing = {user.id for user in users if user.id not in follow_state}
+        following_ids = g.user.following_ids_among(missing)
+
+        for user_id in missing:
+            follow_state[user_id] = user_id in following_ids
+
+    return follow_state
+
+def resolve_like_state(recommendations):
+    """This function loads whether the logged in user liked each of `recommendations`, in one query.
+
+       Results are memoized for the rest of the request in `g.like_state`, so templates
+       can check them with `current_user_likes(recommendation)`.
+    """
+
+    like_state = g.setdefault('like_state', {})
+
+    if g.user:
+        missing = {recommendation.id for recommendation in recommendations if recommendation.id not in like_state}
+        liked_ids = g.user.liked_ids_among(missing)
+
+        for recommendation_id in missing:
+            like_state[recommendation_id] = recommendation_id in liked_ids
+
+    return like_state
+
+@bp.app_template_global()
+def current_user_likes(recommendation):
+    """This template function checks if the logged in user liked `recommendation`.
+
+       Views should call `resolve_like_state` with every recommendation they render first.
+    """
+
+    return resolve_like_state([recommendation]).get(recommendation.id, False)
+
+@bp.app_template_global()
+def current_user_follows(user):
+    """This template function checks if the logged in user follows `user`.
+
+       Views should call `resolve_follow_state` with every user they render first,
+       so that this is a dict lookup instead of a query per user.
+    """
+
+    return resolve_follow_state([user]).get(user.id, False)
+
+def viewer_etag_parts():
+    """This function returns what every page shows about the logged in user (the navbar),
+       to be mixed into the ETags of cacheable pages.
+    """
+
+    if not g.user:
+        return (None, None)
+
+    return (g.user.id, g.user.version)
 
 def login_user(user):
     """This function logs in an existing user"""
@@ -74,8 +178,10 @@ def logout_user():
     if CURR_LOCATION in session:
         del session[CURR_LOCATION]
 
+    session.pop(LOCATION_CHECKED_KEY, None)
+
 
-@app.route('/register', methods=["GET", "POST"])
+@bp.route('/register', methods=["GET", "POST"])
 def register():
     """This view function handles the registeration of a new user.
 
@@ -117,7 +223,7 @@ def register():
         return render_template('users/register.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """This view function handles the login of an existing user"""
 
@@ -130,6 +236,9 @@ def login():
                             
                     
         if user:
+            # Saves the password hash if authenticate upgraded its work factor.
+            db.session.commit()
+            forget_cached_user(user.id)
             login_user(user)
             flash(f"Welcome, {user.username}!", "success")
             return redirect("/")
@@ -138,7 +247,7 @@ def login():
 
     return render_template('users/login.html', form=form)
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """This view function handles the logout of an existing user."""
 
@@ -151,7 +260,7 @@ def logout():
 ####################################################################################
 #General user routes:
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
     """This view function renders a page that lists users.
 
@@ -162,16 +271,28 @@ def list_users():
         flash("Access Unauthorized, please login in!", "danger")
         return redirect("/login")
 
-    search = request.args.get('q')
+    search = request.args.get('q', '').strip()
+    page = users_page(search, request.args.get('before'))
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    resolve_follow_state(page.items)
 
-    return render_template('users/user_list.html', users=users)
+    return render_template('users/user_list.html', users=page.items, search=search, next_cursor=page.next_cursor)
+
+def users_page(search, cursor):
+    """This function returns a Page of the users matching `search` (most relevant first),
+       or of all users (newest first) when there is no search term.
+    """
 
-@app.route('/users/datelocations')
+    try:
+        if search:
+            return User.search(search, cursor, USERS_PAGE_SIZE)
+
+        return User.directory(cursor, USERS_PAGE_SIZE)
+
+    except InvalidCursor:
+        abort(400)
+
+@bp.route('/users/datelocations')
 def show_date_locations():
     """This view function renders a page that shows the date locations according to the 
        location in the global flask environment and the users entered interest.
@@ -180,11 +301,9 @@ def show_date_locations():
         flash("Access Unauthorized, please login in!", "danger")
         return redirect("/")
     
-    location = Location.query.get(session[CURR_LOCATION])
-
-    return render_template('users/date_locations.html', location=location)
+    return render_template('users/date_locations.html', location=g.location)
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
 def show_user(user_id):
     """This view function shows information on a particular 
         user. It renders the user profile.
@@ -197,22 +316,31 @@ def show_user(user_id):
     user = User.query.get_or_404(user_id)
 
     # We want to also retrieve all recommendations made by the user
-    # in order.
+    # in order, one page at a time.
 
-    recommendations = (Recommendation
-                       .query
-                       .filter(Recommendation.user_id == user_id)
-                       .order_by(Recommendation.created_on.desc())
-                       .limit(50)
-                       .all())
+    page = user_recommendations_page(user_id, request.args.get('before'))
+
+    # The profile shows the viewer's own address, or the city of the user's latest location.
+    if g.user.id == user.id:
+        location = g.location.address if g.location else None
+    elif user.locations:
+        location = (user.locations[-1].city, user.locations[-1].state)
+    else:
+        location = None
+
+    resolve_follow_state([user])
+    etag = etag_for('user', user.id, user.version, user.recommendation_count, user.following_count,
+                    user.followers_count, user.likes_count, location, current_user_follows(user),
+                    [(recommendation.id, recommendation.version) for recommendation in page.items],
+                    page.next_cursor, *viewer_etag_parts())
 
-    likes = [recommendation.id for recommendation in user.likes]
-   
     last = -1
-    return render_template('users/user_profile.html', user=user, recommendations=recommendations, likes=likes, last=last)
+    return conditional_render(etag, lambda: render_template('users/user_profile.html', user=user,
+                                                            recommendations=page.items,
+                                                            next_cursor=page.next_cursor, last=last))
 
 
-@app.route('/users/location/edit', methods=['GET', 'POST'])
+@bp.route('/users/location/edit', methods=['GET', 'POST'])
 def edit_location():
     """This view function is used to edit the user's location."""
 
@@ -231,7 +359,7 @@ def edit_location():
 
         name = form.name.data
         address = form.address.data
-        lat_lng_addy = get_lat_lng(GEOCODE_API_KEY, address)
+        lat_lng_addy = cached_get_lat_lng(current_app.config['GEOCODE_API_KEY'], address)
 
         if lat_lng_addy["latitude"] == 0 and lat_lng_addy["longitude"] == 0:
             flash("The address you've entered is not a valid address", "danger")
@@ -244,13 +372,21 @@ def edit_location():
         location.city=lat_lng_addy["city"]
         location.state=lat_lng_addy["state"]
         
-        db.session.commit()
+        set_current_location(g.user, location.id)
         return redirect('/users/datelocations')
 
     return render_template('users/edit_location.html', form=form)
 
 
-@app.route('/users/<int:user_id>/following')
+def social_page(fetch, cursor):
+    """This function calls `fetch` (e.g. user.following_page) for the page after `cursor`."""
+
+    try:
+        return fetch(cursor, SOCIAL_PAGE_SIZE)
+    except InvalidCursor:
+        abort(400)
+
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of users this user is following."""
 
@@ -259,10 +395,12 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    page = social_page(user.following_page, request.args.get('before'))
+    resolve_follow_state(page.items)
+    return render_template('users/following.html', user=user, following=page.items, next_cursor=page.next_cursor)
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def show_followers(user_id):
     """Show list of followers of this user."""
 
@@ -271,9 +409,11 @@ def show_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    page = social_page(user.followers_page, request.args.get('before'))
+    resolve_follow_state(page.items)
+    return render_template('users/followers.html', user=user, followers=page.items, next_cursor=page.next_cursor)
 
-@app.route('/users/<int:user_id>/likes')
+@bp.route('/users/<int:user_id>/likes')
 def show_likes(user_id):
     """Show list of recommendations liked by the logged-in user"""
 
@@ -282,10 +422,11 @@ def show_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user, likes=user.likes)
+    page = social_page(user.likes_page, request.args.get('before'))
+    return render_template('users/likes.html', user=user, likes=page.items, next_cursor=page.next_cursor)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """This view function allows the logged in user to follow any user."""
 
@@ -294,13 +435,26 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+
+    # Following goes through the Follows model so the follow counters are kept up to date.
+    if not Follows.query.filter_by(user_following_id=g.user.id, user_being_followed_id=followed_user.id).first():
+        db.session.add(Follows(user_following_id=g.user.id, user_being_followed_id=followed_user.id))
+
+        # Two clicks racing each other can both pass the check above; the unique index
+        # rejects the second insert, which leaves the user followed once, as asked.
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+        # Both users' follow counters changed.
+        forget_cached_user(g.user.id)
+        forget_cached_user(followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/unfollow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/unfollow/<int:follow_id>', methods=['POST'])
 def unfollow(follow_id):
     """This view function allows logged-in-user to unfollow this user."""
 
@@ -308,15 +462,19 @@ def unfollow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    follow = Follows.query.filter_by(user_following_id=g.user.id, user_being_followed_id=follow_id).first()
+
+    if follow:
+        db.session.delete(follow)
+        db.session.commit()
+        forget_cached_user(g.user.id)
+        forget_cached_user(follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 
-@app.route('/users/edit', methods=['GET', 'POST'])
+@bp.route('/users/edit', methods=['GET', 'POST'])
 def edit_user_details():
     """This view function allows a user to edit their information."""
 
@@ -342,6 +500,7 @@ def edit_user_details():
             user.bio = form.bio.data
 
             db.session.commit()
+            forget_cached_user(user.id)
             flash("Profile succesfully updated!", "success")
             return redirect(f"/users/{user.id}")
 
@@ -351,7 +510,7 @@ def edit_user_details():
 
 
 
-@app.route('/users/delete', methods=['POST'])
+@bp.route('/users/delete', methods=['POST'])
 def delete_user():
     """This view function deletes user account from the dateMeet db"""
     if not g.user:
@@ -360,8 +519,10 @@ def delete_user():
 
     logout()
 
+    g.user.release_counters()
     db.session.delete(g.user)
     db.session.commit()
+    forget_cached_user(g.user.id)
 
     return redirect('/register')
 
@@ -370,7 +531,49 @@ def delete_user():
 ##############################################################################
 # Recommendations routes:
 
-@app.route('/recommendations/list')
+# The orders the city feed can be sorted in, and the keyset columns (all descending) of each.
+# Every order has a matching (business_city, business_state, ...) index.
+FEED_SORTS = {
+    'newest': [Recommendation.created_on, Recommendation.id],
+    'popular': [Recommendation.likes_count, Recommendation.id],
+    'rating': [Recommendation.business_rating, Recommendation.created_on, Recommendation.id],
+}
+
+def city_feed_page(location, cursor=None, sort='newest'):
+    """This function returns one page of the recommendations in the city of `location`,
+       newest first or in another order of FEED_SORTS.
+
+       Pages are fetched by keyset on the sort columns so every page costs the same.
+       Cursors carry the sort name, so a cursor from another order is a 400.
+    """
+
+    if sort not in FEED_SORTS:
+        abort(400)
+
+    query = (Recommendation
+             .query
+             .options(db.joinedload('user'))
+             .filter((location.city == Recommendation.business_city) & (location.state == Recommendation.business_state)))
+
+    try:
+        return keyset_page(query, FEED_SORTS[sort], cursor, FEED_PAGE_SIZE, scope=sort)
+    except InvalidCursor:
+        abort(400)
+
+def user_recommendations_page(user_id, cursor=None):
+    """This function returns one page of the recommendations made by a user, newest first."""
+
+    query = (Recommendation
+             .query
+             .options(db.joinedload('user'))
+             .filter(Recommendation.user_id == user_id))
+
+    try:
+        return keyset_page(query, [Recommendation.created_on, Recommendation.id], cursor, PROFILE_PAGE_SIZE)
+    except InvalidCursor:
+        abort(400)
+
+@bp.route('/recommendations/list')
 def list_recommendations():
     """This view function renders a template where recommendations for a particular 
         city can be viewed by users in that city.
@@ -383,17 +586,131 @@ def list_recommendations():
         flash("Location does not exist, please enter your location!", "danger")
         return redirect("/")
 
-    
-    recommendations = (Recommendation
-                       .query
-                       .filter((g.location.city == Recommendation.business_city) & (g.location.state == Recommendation.business_state))
-                       .order_by(Recommendation.created_on.desc())
-                       .limit(100)
-                       .all())
+    sort = request.args.get('sort', 'newest')
+    page = city_feed_page(g.location, request.args.get('before'), sort)
+    resolve_like_state(page.items)
+
+    return render_template('recommendations/list_recommendations.html', recommendations=page.items,
+                           next_cursor=page.next_cursor, sort=sort)
+
+def timeline_page(user, cursor=None):
+    """This function returns one page of the home timeline of `user`, newest first."""
+
+    try:
+        return TimelineEntry.page_for(user, cursor, FEED_PAGE_SIZE)
+    except InvalidCursor:
+        abort(400)
+
+@bp.route('/timeline')
+def show_timeline():
+    """This view function renders the recommendations of the users the logged in user follows."""
+    if not g.user:
+        flash("Access unauthorized, please log in.", "danger")
+        return redirect("/")
+
+    page = timeline_page(g.user, request.args.get('before'))
+    resolve_like_state(page.items)
+
+    return render_template('recommendations/list_recommendations.html', recommendations=page.items, next_cursor=page.next_cursor)
+
+@bp.route('/recommendations/trending')
+def list_trending_recommendations():
+    """This view function renders the recommendations liked the most, recently, in the
+        logged in user's city.
+    """
+    if not g.user:
+        flash("Access unauthorized, please log in.", "danger")
+        return redirect("/")
+
+    if not g.location:
+        flash("Location does not exist, please enter your location!", "danger")
+        return redirect("/")
+
+    recommendations = TrendingRecommendation.top(g.location.city, g.location.state)
+    resolve_like_state(recommendations)
 
     return render_template('recommendations/list_recommendations.html', recommendations=recommendations)
 
-@app.route('/recommendations/new', methods=["GET", "POST"])
+@bp.route('/recommendations/nearby')
+def list_nearby_recommendations():
+    """This view function renders the recommendations within `radius` km (10 by default)
+        of the logged in user's current location, closest first.
+    """
+    if not g.user:
+        flash("Access unauthorized, please log in.", "danger")
+        return redirect("/")
+
+    if not g.location:
+        flash("Location does not exist, please enter your location!", "danger")
+        return redirect("/")
+
+    radius = min(max(request.args.get('radius', 10, type=float), 0.1), MAX_NEARBY_RADIUS_KM)
+
+    recommendations = []
+    for recommendation, distance_km in Recommendation.within_radius(g.location.lat, g.location.long, radius):
+        recommendation.distance_km = distance_km
+        recommendations.append(recommendation)
+
+    resolve_like_state(recommendations)
+
+    return render_template('recommendations/list_recommendations.html', recommendations=recommendations, radius=radius)
+
+def recommendation_search_page(args):
+    """This function returns a Page of the recommendations matching the 'q', 'city', 'state',
+       'min_rating' and 'before' params in `args`, or None when 'q' is empty.
+    """
+
+    terms = args.get('q', '').strip()
+    if not terms:
+        return None
+
+    try:
+        return Recommendation.search(terms,
+                                     city=args.get('city'),
+                                     state=args.get('state'),
+                                     min_rating=args.get('min_rating', type=int),
+                                     cursor=args.get('before'),
+                                     per_page=SEARCH_PAGE_SIZE)
+    except InvalidCursor:
+        abort(400)
+
+@bp.route('/recommendations/search')
+def search_recommendations():
+    """This view function renders the recommendations matching a search, best match first.
+
+    It takes a 'q' param and optional 'city', 'state' and 'min_rating' filters.
+    """
+    if not g.user:
+        flash("Access unauthorized, please log in.", "danger")
+        return redirect("/")
+
+    page = recommendation_search_page(request.args)
+
+    return render_template('recommendations/search_recommendations.html',
+                           recommendations=page.items if page else [],
+                           next_cursor=page.next_cursor if page else None,
+                           searched=page is not None)
+
+def locate_recommendation(recommendation):
+    """This function geocodes the business address of a recommendation and saves its coordinates.
+
+       Recommendations whose address cannot be geocoded are saved without coordinates
+       and will not show up in nearby searches.
+    """
+
+    address = ", ".join([recommendation.business_address,
+                         recommendation.business_city,
+                         recommendation.business_state,
+                         recommendation.business_country])
+    lat_lng_addy = cached_get_lat_lng(current_app.config['GEOCODE_API_KEY'], address)
+
+    if lat_lng_addy["latitude"] == 0 and lat_lng_addy["longitude"] == 0:
+        return False
+
+    recommendation.set_coordinates(lat_lng_addy["latitude"], lat_lng_addy["longitude"])
+    return True
+
+@bp.route('/recommendations/new', methods=["GET", "POST"])
 def add_recommendation():
     """This view function renders the form to add a new recommendation
        if a GET request is made. 
@@ -416,23 +733,32 @@ def add_recommendation():
                                         business_state=form.business_state.data,
                                         business_country=form.business_country.data,
                                         business_rating=form.business_rating.data)
+        locate_recommendation(recommendation)
         g.user.recommendations.append(recommendation)
+        db.session.flush()
+        TimelineEntry.fan_out(recommendation)
         db.session.commit()
+        forget_cached_user(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('recommendations/new.html', form=form)
 
 
-@app.route('/recommendations/<int:recommendation_id>', methods=["GET"])
+@bp.route('/recommendations/<int:recommendation_id>', methods=["GET"])
 def show_recommendation(recommendation_id):
     """Show a recommendation."""
 
-    recommendation = Recommendation.query.get_or_404(recommendation_id)
-    return render_template('recommendations/show_recommendation.html', recommendation=recommendation)
+    recommendation = Recommendation.query.options(db.joinedload('user')).get_or_404(recommendation_id)
+
+    etag = etag_for('recommendation', recommendation.id, recommendation.version, recommendation.user.version,
+                    g.user and current_user_follows(recommendation.user), *viewer_etag_parts())
 
+    return conditional_render(etag, lambda: render_template('recommendations/show_recommendation.html',
+                                                            recommendation=recommendation))
 
-@app.route('/recommendations/<int:recommendation_id>/delete', methods=["POST"])
+
+@bp.route('/recommendations/<int:recommendation_id>/delete', methods=["POST"])
 def delete_recommendation(recommendation_id):
     """Delete a recommendation."""
 
@@ -447,13 +773,14 @@ def delete_recommendation(recommendation_id):
 
     db.session.delete(recommendation)
     db.session.commit()
+    forget_cached_user(g.user.id)
 
     return redirect(f"/users/{g.user.id}")
 
 ##################################################################################
 #Likes route
 
-@app.route('/recommendations/<int:recommendation_id>/like', methods=['POST'])
+@bp.route('/recommendations/<int:recommendation_id>/like', methods=['POST'])
 def like_and_unlike(recommendation_id):
     """This view function allows a user to like and unlike a particular recommendation"""
 
@@ -466,26 +793,69 @@ def like_and_unlike(recommendation_id):
     if liked_recommendation.user_id == g.user.id:
         return abort(403)
 
-    user_likes = g.user.likes
-    # This conditional removes the like from the user_likes if it already exist in user_likes hence 
-    #providing us with the unlike feature.
-    if liked_recommendation in user_likes:
-        g.user.likes = [like for like in user_likes if like != liked_recommendation]
+    # Likes.toggle removes the like if it already exists, hence 
+    # providing us with the unlike feature.
+    Likes.toggle(g.user.id, liked_recommendation.id)
+    db.session.commit()
+    forget_cached_user(g.user.id)
 
-    else:
-        g.user.likes.append(liked_recommendation)
+    return redirect("/recommendations/list")
+
+
+
+
+##################################################################################
+# Maintenance commands
+
+@click.command('geocode-recommendations')
+@with_appcontext
+def geocode_recommendations():
+    """Geocode the recommendations saved without coordinates."""
+
+    recommendations = Recommendation.query.filter(Recommendation.business_geohash == None).all()
+    located = 0
+
+    for recommendation in recommendations:
+        if locate_recommendation(recommendation):
+            located += 1
 
     db.session.commit()
+    print(f"Geocoded {located} of {len(recommendations)} recommendations.")
 
-    return redirect("/recommendations/list")
+@click.command('reindex-recommendations')
+@with_appcontext
+def reindex_recommendations():
+    """Rebuild the full text search document of every recommendation."""
+
+    reindexed = Recommendation.reindex()
+    db.session.commit()
+    print(f"Reindexed {reindexed} recommendations.")
+
+@click.command('reconcile-trending')
+@with_appcontext
+def reconcile_trending():
+    """Rebuild the trending scores from recent likes and trim every city to its top recommendations."""
 
+    kept = TrendingRecommendation.reconcile()
+    db.session.commit()
+    print(f"Kept {kept} trending recommendations.")
+
+@click.command('reconcile-counters')
+@with_appcontext
+def reconcile_counters():
+    """Recount the follower, following, like and recommendation counters of every user, and
+    the like counts of every recommendation."""
 
+    drifted = User.reconcile_counters()
+    drifted_recommendations = Recommendation.reconcile_counters()
+    db.session.commit()
+    print(f"Repaired the counters of {drifted} users and {drifted_recommendations} recommendations.")
 
 
 ##################################################################################
 # Homepage and error pages
 
-@app.route('/', methods=['GET','POST'])
+@bp.route('/', methods=['GET','POST'])
 def homepage():
     """This view function takes you to the dateMeet homepage
     
@@ -495,11 +865,17 @@ def homepage():
     """
 
     if g.user:
-        recent_location = Location.query.filter(Location.user_id == g.user.id).order_by(Location.id.desc()).first()
-        if recent_location:
-            session[CURR_LOCATION] = recent_location.id
-            g.location = recent_location
-        if g.location:
+        # Users who entered a location before current_location_id existed get it set
+        # from their latest location once. Adding a location sets the pointer, so a user
+        # found to have none isn't looked up again this session.
+        if g.user.current_location_id is None and session.get(LOCATION_CHECKED_KEY) != g.user.id:
+            set_current_location(g.user, g.user.latest_location_id())
+
+            if g.user.current_location_id is None:
+                session[LOCATION_CHECKED_KEY] = g.user.id
+
+        if g.user.current_location_id:
+            session[CURR_LOCATION] = g.user.current_location_id
             return redirect('/users/datelocations')
 
         form=UserLocationForm()
@@ -508,7 +884,7 @@ def homepage():
 
             name = form.name.data
             address = form.address.data
-            lat_lng_addy = get_lat_lng(GEOCODE_API_KEY, address)
+            lat_lng_addy = cached_get_lat_lng(current_app.config['GEOCODE_API_KEY'], address)
 
             if lat_lng_addy["latitude"] == 0 and lat_lng_addy["longitude"] == 0:
                 flash("The address you've entered is not a valid address", "danger")
@@ -526,7 +902,8 @@ def homepage():
             )
 
             db.session.add(location)
-            db.session.commit()
+            db.session.flush()
+            set_current_location(g.user, location.id)
 
             session[CURR_LOCATION] = location.id
 
@@ -537,7 +914,7 @@ def homepage():
     else:
         return render_template('home-anon.html')
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def page_not_found(e):
     """This view function renders an error page"""
     return render_template("404.html"), 404
@@ -545,40 +922,277 @@ def page_not_found(e):
 #######################################################################################
 #Yelp Api requets 
 
-@app.route('/dateMeet/api/yelp-business-search', methods=['POST'])
+@bp.route('/dateMeet/api/yelp-business-search', methods=['POST'])
 def retrieve_businesses():
     """This view function retrieves business information based on a existing location and 
         entered interest.
     """
    
+    if not g.location:
+        return jsonify({"businesses": [], "error": "Please enter your location first."}), 400
+
     interest = request.json['interest']
-    location = Location.query.get(session[CURR_LOCATION])
-    address = location.address
+    address = g.location.address
 
-    response = yelp_business_search(YELP_API_SECRET_KEY, address,interest)
+    try:
+        response = cached_yelp_business_search(current_app.config['YELP_API_SECRET_KEY'], address,interest)
+    except ProviderUnavailable:
+        return jsonify({"businesses": [], "error": "Yelp is not responding right now, please try again later."}), 503
 
     return jsonify(response)
 
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# This was taken from Stack Overflow, the link is given below 
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(r):
+@bp.route('/dateMeet/api/yelp-business-search/multi', methods=['POST'])
+def retrieve_businesses_for_interests():
+    """This view function retrieves businesses for several interests (and optionally several
+        pages of results) around the current location in one request.
+
+        It expects JSON like {"interests": ["dinner", "drinks", "dessert"], "pages": 2}.
+    """
+    if not g.user:
+        return abort(401)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+
+    interests = data.get('interests', [])
+    pages = data.get('pages', 1)
+
+    if isinstance(interests, str):
+        interests = interests.split(',')
+
+    if not isinstance(interests, list) or not all(isinstance(interest, str) for interest in interests):
+        return jsonify({"businesses": [], "error": "interests must be a list of words."}), 400
+
+    try:
+        pages = int(pages)
+    except (TypeError, ValueError):
+        return jsonify({"businesses": [], "error": "pages must be a number."}), 400
+
+    if not 1 <= pages <= MAX_FANOUT_PAGES:
+        return jsonify({"businesses": [], "error": f"pages must be between 1 and {MAX_FANOUT_PAGES}."}), 400
+
+    if not g.location:
+        return jsonify({"businesses": [], "error": "Please enter your location first."}), 400
+
+    try:
+        response = yelp_multi_business_search(current_app.config['YELP_API_SECRET_KEY'], g.location.address, interests, pages)
+    except ProviderUnavailable:
+        return jsonify({"businesses": [], "error": "Yelp is not responding right now, please try again later."}), 503
+
+    return jsonify(response)
+
+@bp.route('/dateMeet/api/recommendations')
+def recommendations_feed_api():
+    """This view function returns one page of the recommendations in the logged in user's 
+        city as JSON. Pass the returned `next_cursor` as `before` to get the next page.
+    """
+    if not g.user:
+        return abort(401)
+
+    if not g.location:
+        return jsonify({"recommendations": [], "next_cursor": None})
+
+    page = city_feed_page(g.location, request.args.get('before'), request.args.get('sort', 'newest'))
+
+    return jsonify({"recommendations": [recommendation.serialize() for recommendation in page.items],
+                    "next_cursor": page.next_cursor})
+
+@bp.route('/dateMeet/api/timeline')
+def timeline_api():
+    """This view function returns one page of the logged in user's home timeline as JSON."""
+
+    if not g.user:
+        return abort(401)
+
+    page = timeline_page(g.user, request.args.get('before'))
+
+    return jsonify({"recommendations": [recommendation.serialize() for recommendation in page.items],
+                    "next_cursor": page.next_cursor})
+
+@bp.route('/dateMeet/api/recommendations/trending')
+def trending_recommendations_api():
+    """This view function returns the trending recommendations in the logged in user's city as JSON."""
+
+    if not g.user:
+        return abort(401)
+
+    if not g.location:
+        return jsonify({"recommendations": []})
+
+    recommendations = TrendingRecommendation.top(g.location.city, g.location.state)
+
+    return jsonify({"recommendations": [recommendation.serialize() for recommendation in recommendations]})
+
+@bp.route('/dateMeet/api/users/<int:user_id>/recommendations')
+def user_recommendations_api(user_id):
+    """This view function returns one page of the recommendations made by a user as JSON."""
+
+    if not g.user:
+        return abort(401)
+
+    User.query.get_or_404(user_id)
+    page = user_recommendations_page(user_id, request.args.get('before'))
+
+    return jsonify({"recommendations": [recommendation.serialize() for recommendation in page.items],
+                    "next_cursor": page.next_cursor})
+
+@bp.route('/dateMeet/api/users/<int:user_id>/following')
+def user_following_api(user_id):
+    """This view function returns one page of the users a user is following as JSON."""
+
+    if not g.user:
+        return abort(401)
+
+    page = social_page(User.query.get_or_404(user_id).following_page, request.args.get('before'))
+
+    return jsonify({"users": [user.serialize() for user in page.items],
+                    "next_cursor": page.next_cursor})
+
+@bp.route('/dateMeet/api/users/<int:user_id>/followers')
+def user_followers_api(user_id):
+    """This view function returns one page of the followers of a user as JSON."""
+
+    if not g.user:
+        return abort(401)
+
+    page = social_page(User.query.get_or_404(user_id).followers_page, request.args.get('before'))
+
+    return jsonify({"users": [user.serialize() for user in page.items],
+                    "next_cursor": page.next_cursor})
+
+@bp.route('/dateMeet/api/users/<int:user_id>/likes')
+def user_likes_api(user_id):
+    """This view function returns one page of the recommendations a user liked as JSON."""
+
+    if not g.user:
+        return abort(401)
+
+    page = social_page(User.query.get_or_404(user_id).likes_page, request.args.get('before'))
+
+    return jsonify({"recommendations": [recommendation.serialize() for recommendation in page.items],
+                    "next_cursor": page.next_cursor})
+
+@bp.route('/dateMeet/api/recommendations/search')
+def recommendations_search_api():
+    """This view function returns a page of the recommendations matching a search as JSON.
+
+       It takes the same params as /recommendations/search.
+    """
+
+    if not g.user:
+        return abort(401)
+
+    page = recommendation_search_page(request.args)
+    if page is None:
+        return jsonify({"recommendations": [], "next_cursor": None})
+
+    return jsonify({"recommendations": [recommendation.serialize() for recommendation in page.items],
+                    "next_cursor": page.next_cursor})
+
+@bp.route('/dateMeet/api/users/search')
+def users_search_api():
+    """This view function returns a page of users matching the 'q' param as JSON.
+
+       The 'before' param takes the next_cursor of the previous page.
+    """
+
+    if not g.user:
+        return abort(401)
+
+    page = users_page(request.args.get('q', '').strip(), request.args.get('before'))
+
+    return jsonify({"users": [user.serialize() for user in page.items],
+                    "next_cursor": page.next_cursor})
+
+@bp.route('/dateMeet/api/users/typeahead')
+def users_typeahead_api():
+    """This view function returns the users whose username starts with the 'q' param as JSON."""
+
+    if not g.user:
+        return abort(401)
+
+    users = User.typeahead(request.args.get('q', ''), TYPEAHEAD_LIMIT)
+
+    return jsonify({"users": [{"id": id, "username": username, "image_url": image_url}
+                              for id, username, image_url in users]})
+
+@bp.route('/dateMeet/api/recommendations/<int:recommendation_id>/like', methods=['POST'])
+def toggle_like_api(recommendation_id):
+    """This view function likes or unlikes a recommendation for the logged-in user and
+       returns the new state and like count as JSON, so the page does not have to reload.
     """
-    Add headers to both force latest IE rendering engine or Chrome Frame,
-    and also to cache the rendered page for 10 minutes.
+
+    if not g.user:
+        return abort(401)
+
+    recommendation = Recommendation.query.get_or_404(recommendation_id)
+    if recommendation.user_id == g.user.id:
+        return abort(403)
+
+    liked = Likes.toggle(g.user.id, recommendation.id)
+    db.session.commit()
+    forget_cached_user(g.user.id)
+
+    return jsonify({"recommendation_id": recommendation.id,
+                    "liked": liked,
+                    "count": recommendation.likes_count})
+
+@bp.route('/dateMeet/api/cache-stats')
+def cache_stats():
+    """This view function reports the hit, miss and expiry counts of the app caches
+       for the worker that serves the request.
     """
-    r.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    r.headers["Pragma"] = "no-cache"
-    r.headers["Expires"] = "0"
-    r.headers['Cache-Control'] = 'public, max-age=0'
-    return r
+    if not g.user:
+        return abort(401)
+
+    return jsonify({"geocode": geocode_cache_stats(),
+                    "yelp": yelp_cache_stats(),
+                    "providers": provider_stats(),
+                    "fragments": fragment_cache_stats(current_app),
+                    "compression": compression_stats(),
+                    "images": image_cache_stats(current_app)})
+
+##################################################################################
+# Application factory
+
+MAINTENANCE_COMMANDS = (geocode_recommendations, reindex_recommendations, reconcile_trending, reconcile_counters)
+
+
+def create_app(config_name=None):
+    """This function creates the dateMeet app with the settings of `config_name`
+       ('dev', 'test' or 'prod', see config.py).
+
+       `flask run` finds it on its own; gunicorn calls it from the Procfile.
+    """
+
+    config_name = config_name or os.environ.get('DATEMEET_ENV', 'dev')
+
+    app = Flask(__name__, static_folder='Static', static_url_path='/static')
+    app.app_ctx_globals_class = LazyGlobals
+    app.config.from_object(CONFIGS[config_name])
+    load_api_keys(app)
+
+    Bootstrap(app)
+
+    # The toolbar instruments every request and rewrites every page, so it is only
+    # imported and installed in development.
+    if app.config['DEBUG_TOOLBAR']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
 
+    connect_db(app)
+    init_passwords(app)
+    init_query_recorder(app)
+    init_fragment_cache(app)
+    init_http_caching(app)
+    init_assets(app)
+    init_compression(app)
+    init_images(app)
 
+    app.register_blueprint(bp)
 
+    for command in MAINTENANCE_COMMANDS:
+        app.cli.add_command(command)
 
+    return app
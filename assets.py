@@ -0,0 +1,115 @@
+"""This file serves the fingerprinted static assets of the dateMeet app.
+
+`python build_assets.py` bundles the third party libraries (saved under Static/vendor)
+with our own CSS and JS, names every built file after a hash of its content and writes
+gzip and brotli copies of the text files to Static/dist, along with a manifest.json
+mapping asset names to built names. Built files never change, so they are served with
+far-future immutable caching, and the precompressed copy the browser accepts is sent
+as it is, with the matching Content-Encoding.
+
+Templates link assets with `asset_url(name)` / `asset_urls(name)`. Without a build
+(in development) they fall back to the source files, or to the CDN for vendored
+libraries that were never downloaded.
+"""
+
+import json
+import mimetypes
+import os
+
+from flask import current_app, request, send_from_directory, url_for
+
+from http_caching import cache_policy, IMMUTABLE_CACHE_CONTROL
+
+STATIC_FOLDER = 'Static'
+DIST_FOLDER = 'dist'
+VENDOR_FOLDER = 'vendor'
+MANIFEST = 'manifest.json'
+
+# Third party libraries, saved under Static/vendor by build_assets.py.
+VENDOR = {
+    'bootstrap.min.css': 'https://unpkg.com/bootstrap@4.6.0/dist/css/bootstrap.min.css',
+    'jquery.min.js': 'https://unpkg.com/jquery@3.6.0/dist/jquery.min.js',
+    'bootstrap.bundle.min.js': 'https://unpkg.com/bootstrap@4.6.0/dist/js/bootstrap.bundle.min.js',
+    'axios.min.js': 'https://unpkg.com/axios@0.21.1/dist/axios.min.js',
+}
+
+# Every bundle is built from these files (relative to Static/), in order.
+# bootstrap.bundle includes popper, so popper isn't vendored separately.
+BUNDLES = {
+    'app.css': ['vendor/bootstrap.min.css', 'style.css'],
+    'vendor.js': ['vendor/jquery.min.js', 'vendor/bootstrap.bundle.min.js', 'vendor/axios.min.js'],
+    'dateMeet.js': ['dateMeet.js'],
+}
+
+# Precompressed copies, in order of preference.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def init_assets(app):
+    """This function loads the asset manifest and adds the built assets route and the
+       asset_url / asset_urls template functions to the app.
+    """
+
+    manifest_path = os.path.join(app.root_path, STATIC_FOLDER, DIST_FOLDER, MANIFEST)
+
+    try:
+        with open(manifest_path) as manifest_file:
+            app.extensions['asset_manifest'] = json.load(manifest_file)
+    except FileNotFoundError:
+        app.extensions['asset_manifest'] = {}
+
+    app.add_url_rule('/static/dist/<path:filename>', 'dist_asset', send_asset)
+    app.add_template_global(asset_url)
+    app.add_template_global(asset_urls)
+
+
+def asset_urls(name):
+    """This function returns the URLs a page has to load for the asset (or bundle) `name`."""
+
+    built_name = current_app.extensions['asset_manifest'].get(name)
+
+    if built_name:
+        return [url_for('dist_asset', filename=built_name)]
+
+    return [source_url(path) for path in BUNDLES.get(name, [name])]
+
+
+def asset_url(name):
+    """This function returns the URL of an asset made of a single file, like an image."""
+
+    return asset_urls(name)[0]
+
+
+def source_url(path):
+    """This function returns the URL of a source file under Static/, or the CDN URL of a
+       vendored library that hasn't been downloaded.
+    """
+
+    folder, _, filename = path.partition('/')
+
+    if folder == VENDOR_FOLDER and not os.path.isfile(os.path.join(current_app.root_path, STATIC_FOLDER, path)):
+        return VENDOR[filename]
+
+    return url_for('static', filename=path)
+
+
+@cache_policy(IMMUTABLE_CACHE_CONTROL)
+def send_asset(filename):
+    """This view function serves a built asset, or its precompressed copy if the browser
+       accepts it.
+    """
+
+    directory = os.path.join(current_app.root_path, STATIC_FOLDER, DIST_FOLDER)
+    mimetype = mimetypes.guess_type(filename)[0]
+
+    for encoding, suffix in ENCODINGS:
+        if encoding in request.accept_encodings and os.path.isfile(os.path.join(directory, filename + suffix)):
+            response = send_from_directory(directory, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename)
+
+    response.vary.add('Accept-Encoding')
+
+    return response
@@ -0,0 +1,59 @@
+"""This script measures how many bcrypt password checks (logins) a machine can do per second.
+
+Run it like:
+
+    python bench_bcrypt.py            # work factors 10 to 13
+    python bench_bcrypt.py 12 --seconds 5
+
+For every work factor it reports checks/sec on one core and on every core, which helps
+pick BCRYPT_LOG_ROUNDS and the number of gunicorn workers.
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+
+def checks_per_second(password_hash, threads, seconds):
+    """This function returns how many checks of `password_hash` `threads` threads do per second."""
+
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        count = 0
+        while time.perf_counter() < deadline:
+            bcrypt.checkpw(b"correct horse battery staple", password_hash)
+            count += 1
+        return count
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        total = sum(pool.map(lambda _: worker(), range(threads)))
+
+    return total / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("rounds", nargs="*", type=int, default=[10, 11, 12, 13])
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+
+    print(f"{'rounds':>6} {'ms/check':>9} {'1 core/s':>9} {f'{cores} cores/s':>11} {'per core/s':>11}")
+
+    for rounds in args.rounds:
+        password_hash = bcrypt.hashpw(b"correct horse battery staple", bcrypt.gensalt(rounds))
+
+        single = checks_per_second(password_hash, 1, args.seconds)
+        parallel = checks_per_second(password_hash, cores, args.seconds)
+
+        print(f"{rounds:>6} {1000 / single:>9.1f} {single:>9.1f} {parallel:>11.1f} {parallel / cores:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""This script measures how long a fresh Python process takes to import and create the app.
+
+Run it like:
+
+    python bench_startup.py                 # every profile, 10 runs each
+    python bench_startup.py prod --runs 20
+    python bench_startup.py prod --imports  # also list the slowest imports
+
+Every run is a new interpreter, like a gunicorn worker booting or a test run starting, so
+nothing is already imported. It reports the median and fastest time to import app.py and
+to call create_app, which tells whether a change made startup slower.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from config import CONFIGS
+
+RUN = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app({profile!r})
+created = time.perf_counter()
+print(json.dumps({{"import": imported - started, "create": created - imported}}))
+"""
+
+
+def time_startup(profile):
+    """This function starts a new interpreter that creates the app with `profile` and
+       returns the seconds spent importing app.py and in create_app.
+    """
+
+    output = subprocess.run([sys.executable, '-c', RUN.format(profile=profile)], check=True,
+                            stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def slowest_imports(profile, count=15):
+    """This function returns the `count` modules that took longest to import (with
+       everything they imported), from `python -X importtime`.
+    """
+
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', RUN.format(profile=profile)], check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+
+    imports = []
+
+    for line in stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative_us), name.strip()))
+
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('profiles', nargs='*', default=list(CONFIGS), help="profiles to measure (default: all)")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--imports', action='store_true', help="list the slowest imports of every profile")
+    args = parser.parse_args()
+
+    for profile in args.profiles:
+        runs = [time_startup(profile) for _ in range(args.runs)]
+        imports = [run["import"] * 1000 for run in runs]
+        creates = [run["create"] * 1000 for run in runs]
+
+        print(f"{profile:5} import app.py: median {statistics.median(imports):7.1f} ms, best {min(imports):7.1f} ms | "
+              f"create_app: median {statistics.median(creates):6.1f} ms, best {min(creates):6.1f} ms")
+
+        if args.imports:
+            for cumulative_us, name in slowest_imports(profile):
+                print(f"      {cumulative_us / 1000:8.1f} ms {name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""This script builds the fingerprinted static assets served from Static/dist (see assets.py).
+
+Run it before starting the app (Heroku runs it from bin/post_compile):
+
+    python build_assets.py
+
+It downloads the libraries in assets.VENDOR that aren't in Static/vendor yet (commit them
+so builds don't depend on the CDN), concatenates and minifies every bundle in
+assets.BUNDLES, copies the other files in Static/ (images, icons), names everything after
+a hash of its content and writes gzip and brotli copies of the text files. The built names
+are recorded in Static/dist/manifest.json.
+
+CSS and JS are minified with rcssmin and rjsmin, and brotli copies need the brotli package.
+Without them files are bundled as they are, or only gzipped.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import requests
+
+from assets import BUNDLES, DIST_FOLDER, MANIFEST, STATIC_FOLDER, VENDOR, VENDOR_FOLDER
+
+try:
+    import rcssmin
+    import rjsmin
+except ImportError:
+    rcssmin = rjsmin = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSED_TYPES = ('.css', '.js', '.svg', '.ico', '.json')
+
+SOURCE_MAP = re.compile(r'^\s*(/\*#|//#) sourceMappingURL=.*$', re.MULTILINE)
+
+
+def fetch_vendor(static_dir):
+    """This function downloads the vendored libraries that are missing from Static/vendor."""
+
+    vendor_dir = os.path.join(static_dir, VENDOR_FOLDER)
+    os.makedirs(vendor_dir, exist_ok=True)
+
+    for filename, url in VENDOR.items():
+        path = os.path.join(vendor_dir, filename)
+
+        if os.path.isfile(path):
+            continue
+
+        print(f"Downloading {url}")
+        resp = requests.get(url, timeout=30)
+        resp.raise_for_status()
+
+        with open(path, 'wb') as vendor_file:
+            vendor_file.write(resp.content)
+
+
+def build_bundle(static_dir, name, sources):
+    """This function returns the content of bundle `name`, made of `sources` minified
+       (unless they already are) and joined.
+    """
+
+    parts = []
+
+    for path in sources:
+        with open(os.path.join(static_dir, path), encoding='utf-8') as source_file:
+            text = SOURCE_MAP.sub('', source_file.read())
+
+        if '.min.' not in path:
+            if name.endswith('.css') and rcssmin:
+                text = rcssmin.cssmin(text)
+            elif name.endswith('.js') and rjsmin:
+                text = rjsmin.jsmin(text)
+
+        parts.append(text.strip())
+
+    # The semicolon keeps a script that doesn't end with one from running into the next.
+    separator = '\n;\n' if name.endswith('.js') else '\n'
+
+    return (separator.join(parts) + '\n').encode('utf-8')
+
+
+def write_asset(dist_dir, name, content):
+    """This function writes `content` under its fingerprinted name (and its compressed
+       copies) and returns that name.
+    """
+
+    stem, ext = os.path.splitext(name)
+    built_name = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+    path = os.path.join(dist_dir, built_name)
+
+    with open(path, 'wb') as asset_file:
+        asset_file.write(content)
+
+    if ext in COMPRESSED_TYPES:
+        with open(path + '.gz', 'wb') as gz_file:
+            # mtime=0 so that the same content always compresses to the same bytes.
+            gz_file.write(gzip.compress(content, compresslevel=9, mtime=0))
+
+        if brotli:
+            with open(path + '.br', 'wb') as br_file:
+                br_file.write(brotli.compress(content, quality=11))
+
+    return built_name
+
+
+def build(static_dir, fetch=True):
+    """This function rebuilds Static/dist and returns the manifest."""
+
+    if fetch:
+        fetch_vendor(static_dir)
+
+    dist_dir = os.path.join(static_dir, DIST_FOLDER)
+    shutil.rmtree(dist_dir, ignore_errors=True)
+    os.makedirs(dist_dir)
+
+    manifest = {}
+
+    for name, sources in BUNDLES.items():
+        manifest[name] = write_asset(dist_dir, name, build_bundle(static_dir, name, sources))
+
+    bundled = {path for sources in BUNDLES.values() for path in sources}
+
+    for name in sorted(os.listdir(static_dir)):
+        path = os.path.join(static_dir, name)
+
+        if name in bundled or name.startswith('.') or not os.path.isfile(path):
+            continue
+
+        with open(path, 'rb') as static_file:
+            manifest[name] = write_asset(dist_dir, name, static_file.read())
+
+    with open(os.path.join(dist_dir, MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--no-fetch', action='store_true',
+                        help="don't download missing vendored libraries")
+    args = parser.parse_args()
+
+    static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), STATIC_FOLDER)
+    manifest = build(static_dir, fetch=not args.no_fetch)
+
+    for name, built_name in sorted(manifest.items()):
+        print(f"{name:30} {built_name}")
+
+    if not (rcssmin and rjsmin):
+        print("rcssmin/rjsmin are not installed, CSS and JS were not minified.")
+    if not brotli:
+        print("brotli is not installed, only gzip copies were written.")
+
+
+if __name__ == '__main__':
+    main()
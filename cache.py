@@ -0,0 +1,272 @@
+"""This file holds the in-process caching helpers used by the dateMeet app."""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_address(address):
+    """This function normalizes an address so that trivially different spellings of the
+       same address ("123 Main St,  Edmonton" and "123 main st, edmonton") share one cache key.
+    """
+
+    address = (address or "").strip().lower()
+    address = re.sub(r"\s*,\s*", ", ", address)
+    address = re.sub(r"\s+", " ", address)
+
+    return address.strip(", ")
+
+
+class LRUCache:
+    """This class holds a bounded, thread safe, least-recently-used cache.
+
+       Every entry is stored with the time it was saved and its own time to live (in seconds),
+       so positive and negative results can expire at different rates. The cache keeps
+       hit, miss and expiry counts that can be reported with `stats()`.
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """This method returns the value saved under `key` or `default` when
+           the key is missing or its entry has expired.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, stored_at, ttl = entry
+
+            if ttl is not None and time.monotonic() - stored_at > ttl:
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """This method saves `value` under `key`, evicting the least recently used
+           entry when the cache is full.
+        """
+
+        ttl = self.ttl if ttl is None else ttl
+
+        with self._lock:
+            self._entries[key] = (value, time.monotonic(), ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """This method removes `key` from the cache if it is present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """This method empties the cache and resets its counters."""
+
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.expired = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """This method returns the counters of this cache as a dictionary."""
+
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions
+        }
+
+
+class SizedLRUCache:
+    """This class holds a thread safe, least-recently-used cache of strings bounded by
+       their total size in bytes rather than by the number of entries.
+
+       Values larger than the whole budget are not cached. Like `LRUCache` it keeps
+       hit, miss and eviction counts that can be reported with `stats()`.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """This method returns the value saved under `key` or `default` when it is missing."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """This method saves `value` under `key`, evicting the least recently used
+           entries until the cache fits in its byte budget again.
+        """
+
+        size = len(value.encode("utf-8"))
+
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+
+            if old is not None:
+                self.size_bytes -= old[1]
+
+            self._entries[key] = (value, size)
+            self.size_bytes += size
+
+            while self.size_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        """This method empties the cache and resets its counters."""
+
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """This method returns the counters of this cache as a dictionary."""
+
+        return {
+            "size": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class StaleWhileRevalidateCache:
+    """This class holds a bounded cache that serves stale entries while they are refreshed.
+
+       Entries younger than `fresh_ttl` seconds are served as they are. Entries older than
+       that, but younger than `fresh_ttl + stale_ttl`, are served immediately while a
+       background thread reloads them. Anything older is loaded on the request thread.
+    """
+
+    def __init__(self, max_size=1024, fresh_ttl=600, stale_ttl=3600):
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self._entries = LRUCache(max_size=max_size, ttl=fresh_ttl + stale_ttl)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.fresh_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def get_or_load(self, key, loader):
+        """This method returns the value cached under `key`, calling `loader()` to
+           fill or refresh the entry when needed.
+        """
+
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            value = loader()
+            self._entries.set(key, (value, time.monotonic()))
+            return value
+
+        value, loaded_at = entry
+
+        if time.monotonic() - loaded_at <= self.fresh_ttl:
+            self.fresh_hits += 1
+        else:
+            self.stale_hits += 1
+            self._refresh_in_background(key, loader)
+
+        return value
+
+    def _refresh_in_background(self, key, loader):
+        """This method reloads `key` on a daemon thread unless a refresh is already running."""
+
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        thread = threading.Thread(target=self._refresh, args=(key, loader), daemon=True)
+        thread.start()
+
+    def _refresh(self, key, loader):
+        """This method runs `loader()` and saves its result. On failure the stale entry is kept."""
+
+        try:
+            value = loader()
+            self._entries.set(key, (value, time.monotonic()))
+            self.refreshes += 1
+        except Exception:
+            self.refresh_errors += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def clear(self):
+        """This method empties the cache and resets its counters."""
+
+        self._entries.clear()
+        self.fresh_hits = self.stale_hits = self.misses = 0
+        self.refreshes = self.refresh_errors = 0
+
+    def stats(self):
+        """This method returns the counters of this cache as a dictionary."""
+
+        stats = self._entries.stats()
+        stats.update({
+            "fresh_hits": self.fresh_hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors
+        })
+
+        return stats
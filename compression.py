@@ -0,0 +1,134 @@
+"""This file holds the response compression of the dateMeet app.
+
+Rendered pages and JSON responses are compressed with brotli or gzip, whichever the
+browser prefers in its Accept-Encoding header. Small bodies aren't worth the CPU time and
+are sent as they are, as are files (static assets are precompressed by build_assets.py)
+and types that are already compressed, like images.
+
+Every compressed response is counted, with the bytes in and out and the CPU time spent,
+so `compression_stats()` can report the ratio we get and what it costs.
+"""
+
+import gzip
+import threading
+import time
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html',
+    'text/plain',
+    'text/css',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+}
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def init_compression(app):
+    """This function turns on response compression for the app.
+
+       COMPRESS_MIN_SIZE is the smallest body (in bytes) that is compressed. The levels are
+       kept low because pages are compressed on every request, unlike static assets.
+    """
+
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 4)
+
+    app.after_request(compress_response)
+
+
+def choose_encoding():
+    """This function returns the encoding the browser prefers among the ones we can produce,
+       or None.
+    """
+
+    encodings = ['br', 'gzip'] if brotli else ['gzip']
+
+    return request.accept_encodings.best_match(encodings)
+
+
+def compress(body, encoding):
+    """This function returns `body` compressed with `encoding` ('br' or 'gzip')."""
+
+    if encoding == 'br':
+        return brotli.compress(body, quality=current_app.config['COMPRESS_BROTLI_QUALITY'])
+
+    return gzip.compress(body, compresslevel=current_app.config['COMPRESS_GZIP_LEVEL'])
+
+
+def compress_response(response):
+    """This function compresses `response` in place when it is worth it."""
+
+    if (response.mimetype not in COMPRESSIBLE_TYPES
+            or response.direct_passthrough
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    # The debug toolbar rewrites pages after this hook runs, so it needs them uncompressed.
+    if current_app.debug or response.status_code < 200 or response.status_code in (204, 304):
+        return response
+
+    encoding = choose_encoding()
+
+    if encoding is None:
+        return response
+
+    body = response.get_data()
+
+    if len(body) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    started = time.thread_time()
+    compressed = compress(body, encoding)
+    cpu_time = time.thread_time() - started
+
+    record(encoding, len(body), len(compressed), cpu_time)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+
+    # The compressed body is not byte for byte what the ETag described any more.
+    if response.get_etag()[0]:
+        response.set_etag(response.get_etag()[0], weak=True)
+
+    return response
+
+
+def record(encoding, bytes_in, bytes_out, cpu_time):
+    """This function adds one compressed response to the counters of `encoding`."""
+
+    with _stats_lock:
+        counters = _stats.setdefault(encoding, {"responses": 0, "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0})
+        counters["responses"] += 1
+        counters["bytes_in"] += bytes_in
+        counters["bytes_out"] += bytes_out
+        counters["cpu_seconds"] += cpu_time
+
+
+def compression_stats():
+    """This function returns the compression counters of this worker, per encoding, with
+       the overall ratio (compressed / original size) and CPU time per response.
+    """
+
+    with _stats_lock:
+        stats = {encoding: dict(counters) for encoding, counters in _stats.items()}
+
+    for counters in stats.values():
+        counters["ratio"] = round(counters["bytes_out"] / counters["bytes_in"], 3)
+        counters["cpu_ms_per_response"] = round(1000 * counters["cpu_seconds"] / counters["responses"], 3)
+
+    return stats
@@ -0,0 +1,85 @@
+"""This file holds the configuration profiles of the dateMeet app.
+
+`create_app` (in app.py) picks one by name: 'dev' for local development (debug mode and the
+debug toolbar), 'test' for the test suite and 'prod' for Heroku. Without a name it uses
+the DATEMEET_ENV environment variable, or 'dev'.
+"""
+
+import importlib
+import os
+
+# API keys are read from the environment or, in development, from secrets.py.
+API_KEYS = ('YELP_API_SECRET_KEY', 'GEOCODE_API_KEY')
+
+
+class Config:
+    """This class holds the settings shared by every profile."""
+
+    # For production and testing we need to get the DB_URI from environ variable
+    # If not DB_URI not yet set in environ variable, we use the development local db.
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgres:///dateMeet')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = os.environ.get('SECRET_KEY', "dateMeetisgr8")
+
+    # Seconds a worker may reuse the logged in user's row without querying it (0 turns this off).
+    # Profile edits, deletes, follows, unfollows, likes and adding or deleting a recommendation
+    # clear it. The cached row never holds the password hash.
+    CURRENT_USER_CACHE_TTL = int(os.environ.get('CURRENT_USER_CACHE_TTL', 0))
+
+    DEBUG_TOOLBAR = False
+
+
+class DevelopmentConfig(Config):
+    """This class holds the settings for local development."""
+
+    DEBUG = True
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+
+class TestingConfig(Config):
+    """This class holds the settings for the test suite."""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///dateMeet_test')
+    WTF_CSRF_ENABLED = False
+    # The lowest work factor bcrypt allows, so registering test users is fast.
+    BCRYPT_LOG_ROUNDS = 4
+
+
+class ProductionConfig(Config):
+    """This class holds the settings for Heroku."""
+
+    # Every worker of a release must make the same ETags. Heroku sets HEROKU_SLUG_COMMIT
+    # (with the dyno metadata feature) at runtime and SOURCE_VERSION during builds.
+    ETAG_SALT = os.environ.get('ETAG_SALT') or os.environ.get('HEROKU_SLUG_COMMIT') or os.environ.get('SOURCE_VERSION')
+
+
+CONFIGS = {
+    'dev': DevelopmentConfig,
+    'test': TestingConfig,
+    'prod': ProductionConfig,
+}
+
+
+def load_api_keys(app):
+    """This function sets the API keys missing from the app config from the environment, or
+       from secrets.py when it exists.
+    """
+
+    local_secrets = None
+
+    for name in API_KEYS:
+        if app.config.get(name):
+            continue
+
+        if name in os.environ:
+            app.config[name] = os.environ[name]
+            continue
+
+        if local_secrets is None:
+            # Our secrets.py shadows the standard library module of the same name when it exists.
+            local_secrets = importlib.import_module('secrets')
+
+        app.config[name] = getattr(local_secrets, name, None)
@@ -0,0 +1,73 @@
+"""This file holds the Jinja fragment cache used by the dateMeet templates.
+
+A block wrapped in
+
+    {% cache 'recommendation-card', recommendation.id, recommendation.version %}
+      ...
+    {% endcache %}
+
+is rendered once and then served from a byte bounded, in-process LRU cache under a key
+made of its arguments. Keys must include a version of everything the block shows
+(see the Card versions section of models.py). Anything that depends on the viewer, like
+like buttons, has to stay outside the block.
+"""
+
+import os
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from cache import SizedLRUCache
+
+
+class FragmentCacheExtension(Extension):
+    """This class adds the `{% cache key, ... %}...{% endcache %}` tag to Jinja."""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=SizedLRUCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        key_parts = [parser.parse_expression()]
+
+        while parser.stream.skip_if('comma'):
+            key_parts.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        return nodes.CallBlock(self.call_method('_render_cached', [nodes.List(key_parts)]),
+                               [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, key_parts, caller):
+        cache = self.environment.fragment_cache
+        key = ':'.join(str(part) for part in key_parts)
+
+        fragment = cache.get(key)
+
+        if fragment is None:
+            fragment = caller()
+            cache.set(key, fragment)
+
+        return fragment
+
+
+def init_fragment_cache(app):
+    """This function adds the fragment cache to the app's templates, sized with
+       FRAGMENT_CACHE_MAX_BYTES (0 turns it off).
+    """
+
+    app.config.setdefault('FRAGMENT_CACHE_MAX_BYTES',
+                          int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES', 8 * 1024 * 1024)))
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.fragment_cache.max_bytes = app.config['FRAGMENT_CACHE_MAX_BYTES']
+
+
+def fragment_cache_stats(app):
+    """This function returns the counters of the app's fragment cache."""
+
+    return app.jinja_env.fragment_cache.stats()
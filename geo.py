@@ -0,0 +1,100 @@
+"""This file holds the geohash and distance helpers used for location based queries in the dateMeet app."""
+
+import math
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+GEOHASH_PRECISION = 9
+
+
+def encode_geohash(lat, lng, precision=GEOHASH_PRECISION):
+    """This function returns the geohash of a point with `precision` characters."""
+
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(geohash) < precision:
+        if even:
+            mid = (lng_range[0] + lng_range[1]) / 2
+            if lng >= mid:
+                bits = (bits << 1) | 1
+                lng_range[0] = mid
+            else:
+                bits = bits << 1
+                lng_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits = bits << 1
+                lat_range[1] = mid
+
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(geohash)
+
+
+def cell_size(precision):
+    """This function returns the (height, width) in degrees of a geohash cell with `precision` characters."""
+
+    lng_bits = math.ceil(precision * 5 / 2)
+    lat_bits = math.floor(precision * 5 / 2)
+
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def covering_cells(lat, lng, radius_km):
+    """This function returns the geohash prefixes whose cells cover every point within
+       `radius_km` of (lat, lng).
+
+       It picks the longest prefix whose cells are at least `radius_km` tall and wide at this
+       latitude, then returns the cell holding the point plus its eight neighbours.
+    """
+
+    lat_km_scale = KM_PER_DEGREE
+    lng_km_scale = KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01)
+
+    precision = 1
+    for p in range(1, GEOHASH_PRECISION + 1):
+        height, width = cell_size(p)
+        if height * lat_km_scale >= radius_km and width * lng_km_scale >= radius_km:
+            precision = p
+        else:
+            break
+
+    height, width = cell_size(precision)
+    cells = []
+
+    for d_lat in (-height, 0, height):
+        for d_lng in (-width, 0, width):
+            n_lat = min(max(lat + d_lat, -90.0), 90.0)
+            n_lng = (lng + d_lng + 180.0) % 360.0 - 180.0
+            cell = encode_geohash(n_lat, n_lng, precision)
+            if cell not in cells:
+                cells.append(cell)
+
+    return cells
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """This function returns the great circle distance between two points in kilometers."""
+
+    d_lat = math.radians(lat2 - lat1)
+    d_lng = math.radians(lng2 - lng1)
+    a = (math.sin(d_lat / 2) ** 2
+         + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(d_lng / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
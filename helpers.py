@@ -1,8 +1,18 @@
-import requests 
-from secrets import YELP_API_SECRET_KEY, GEOCODE_API_KEY
+import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from cache import LRUCache, StaleWhileRevalidateCache, normalize_address
+from http_client import ProviderUnavailable, google_client, yelp_client
+from models import db, GeocodeResult
 
 business_num = 0
 
+YELP_PAGE_SIZE = 50
+
 def get_lat_lng(apiKey, address):
     """
     This method Returns the latitude and longitude of a location using the Google Maps Geocoding API. 
@@ -19,30 +29,44 @@ def get_lat_lng(apiKey, address):
         "longitude": lng          [float]
     }
     """
-    url = ('https://maps.googleapis.com/maps/api/geocode/json?address={}&key={}'
-           .format(address.replace(' ','+'), apiKey))
     try:
-        response = requests.get(url)
-        resp_json_payload = response.json()
-        lat = resp_json_payload['results'][0]['geometry']['location']['lat']
-        lng = resp_json_payload['results'][0]['geometry']['location']['lng']
-        addy = resp_json_payload['results'][0]['formatted_address']
-        address_components = resp_json_payload['results'][0]['address_components']
-
-        if len(address_components) == 8: 
-            city = address_components[3]['short_name']
-            state = address_components[5]['short_name']
-        else:
-            city = address_components[3]['short_name']
-            state = address_components[4]['short_name']
+        location = parse_geocode_response(request_geocode(apiKey, address))
 
     except:
         # print('ERROR: {}'.format(address))
-        lat = 0
-        lng = 0
-        addy = address
-        city = "city"
-        state = "state"
+        location = address_not_found(address)
+
+    return location
+
+
+def request_geocode(apiKey, address):
+    """This method makes the request to the Google Maps Geocoding API and returns the
+       decoded JSON payload. Network errors are raised to the caller as
+       `http_client.ProviderUnavailable`.
+    """
+    url = ('https://maps.googleapis.com/maps/api/geocode/json?address={}&key={}'
+           .format(address.replace(' ','+'), apiKey))
+
+    response = google_client.get(url)
+    return response.json()
+
+
+def parse_geocode_response(resp_json_payload):
+    """This method turns a Google Geocoding payload into the location dictionary
+       returned by `get_lat_lng`. It raises KeyError or IndexError when the payload 
+       does not hold a usable result.
+    """
+    lat = resp_json_payload['results'][0]['geometry']['location']['lat']
+    lng = resp_json_payload['results'][0]['geometry']['location']['lng']
+    addy = resp_json_payload['results'][0]['formatted_address']
+    address_components = resp_json_payload['results'][0]['address_components']
+
+    if len(address_components) == 8: 
+        city = address_components[3]['short_name']
+        state = address_components[5]['short_name']
+    else:
+        city = address_components[3]['short_name']
+        state = address_components[4]['short_name']
 
     location = {
         "full_address": addy,
@@ -52,11 +76,120 @@ def get_lat_lng(apiKey, address):
         "state": state
     }
 
-    
     return location
 
 
-def yelp_business_search(apikey, address, term):
+def address_not_found(address):
+    """This method returns the location dictionary used for addresses that could not be geocoded."""
+
+    return {
+        "full_address": address,
+        "latitude": 0,
+        "longitude": 0,
+        "city": "city",
+        "state": "state"
+    }
+
+
+####################################################################################
+# Geocode cache
+#
+# Results are kept in a bounded in-process LRU, backed by the geocode_cache table so
+# every gunicorn worker (and every restart) shares what has already been resolved.
+# Addresses Google answers with no results are cached too, for a shorter time.
+
+GEOCODE_TTL = datetime.timedelta(days=30)
+GEOCODE_NEGATIVE_TTL = datetime.timedelta(days=1)
+
+geocode_cache = LRUCache(max_size=2048, ttl=GEOCODE_TTL.total_seconds())
+geocode_db_stats = {"hits": 0, "misses": 0, "expired": 0, "api_calls": 0}
+
+
+def cached_get_lat_lng(apiKey, address):
+    """This method returns the same location dictionary as `get_lat_lng`, but looks the
+       normalized address up in the in-process cache and then the geocode_cache table
+       before calling the Google Geocoding API.
+
+       Failed requests (network errors, quota errors) are not cached.
+    """
+    address_key = normalize_address(address)
+
+    if not address_key:
+        return address_not_found(address)
+
+    location = geocode_cache.get(address_key)
+    if location is not None:
+        return dict(location)
+
+    now = datetime.datetime.utcnow()
+    row = GeocodeResult.query.get(address_key)
+
+    if row and row.expires_on > now:
+        geocode_db_stats["hits"] += 1
+        location = row.to_location()
+        geocode_cache.set(address_key, location, ttl=(row.expires_on - now).total_seconds())
+        return dict(location)
+
+    if row:
+        geocode_db_stats["expired"] += 1
+    else:
+        geocode_db_stats["misses"] += 1
+
+    try:
+        geocode_db_stats["api_calls"] += 1
+        payload = request_geocode(apiKey, address)
+    except Exception:
+        return address_not_found(address)
+
+    if payload.get("status") not in ("OK", "ZERO_RESULTS"):
+        return address_not_found(address)
+
+    try:
+        location = parse_geocode_response(payload)
+        found = True
+        ttl = GEOCODE_TTL
+    except (KeyError, IndexError, TypeError):
+        location = address_not_found(address)
+        found = False
+        ttl = GEOCODE_NEGATIVE_TTL
+
+    save_geocode_result(address_key, location, found, now + ttl)
+    geocode_cache.set(address_key, location, ttl=ttl.total_seconds())
+
+    return dict(location)
+
+
+def save_geocode_result(address_key, location, found, expires_on):
+    """This method upserts a geocode result into the geocode_cache table.
+
+       It runs on its own connection so it never commits whatever the caller
+       has pending in the db session.
+    """
+    values = dict(location, address_key=address_key, found=found, expires_on=expires_on)
+    stmt = insert(GeocodeResult.__table__).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[GeocodeResult.__table__.c.address_key],
+        set_={key: stmt.excluded[key] for key in values if key != "address_key"}
+    )
+
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(stmt)
+    except SQLAlchemyError:
+        # The in-process cache still holds the result, the next worker will look it up again.
+        pass
+
+
+def geocode_cache_stats():
+    """This method reports the hit, miss and expiry counts of both geocode cache layers."""
+
+    return {
+        "memory": geocode_cache.stats(),
+        "database": dict(geocode_db_stats)
+    }
+
+
+def yelp_business_search(apikey, address, term, offset=50):
     """This method makes the request to the Yelp API to retrieve businesses
         around a specific location given the address.
 
@@ -66,6 +199,7 @@ def yelp_business_search(apikey, address, term):
         apikey               [str]
         address              [str]
         term                 [str]
+        offset               [int]
 
         #RETURN ----------------------------------------------------------------
         YELP RESPONSE SHOWN IN BUSINESS SEARCH DOCUMENTATION:
@@ -78,15 +212,15 @@ def yelp_business_search(apikey, address, term):
 
 # Define the parameters 
     PARAMS = {'term': term,
-              'limit': 50,
+              'limit': YELP_PAGE_SIZE,
               'radius': 40000,
-              'offset': 50,
+              'offset': offset,
               'sort_by': "distance",
               'location': address}
 
 # Now we make the request to the Yelp API
 
-    response = requests.get(url=ENDPOINT, params=PARAMS, headers=HEADERS)
+    response = yelp_client.get(ENDPOINT, params=PARAMS, headers=HEADERS)
 
 # Convert JSON response to dictionary
 
@@ -128,6 +262,103 @@ def yelp_business_search(apikey, address, term):
     # return business_info
 
 
+####################################################################################
+# Yelp search cache
+#
+# Popular (location, interest) pairs are searched over and over, so results are kept
+# in a bounded stale-while-revalidate cache: fresh results are served as they are and
+# stale ones are served while a background thread refreshes them from Yelp.
+
+YELP_FRESH_TTL = 10 * 60
+YELP_STALE_TTL = 60 * 60
+
+yelp_search_cache = StaleWhileRevalidateCache(max_size=1000, fresh_ttl=YELP_FRESH_TTL, stale_ttl=YELP_STALE_TTL)
+
+
+def normalize_term(term):
+    """This method normalizes a Yelp search term so "Coffee " and "coffee" share one cache key."""
+
+    return " ".join((term or "").lower().split())
+
+
+def cached_yelp_business_search(apikey, address, term, offset=50):
+    """This method returns the same payload as `yelp_business_search`, served from the
+       Yelp search cache when the normalized location and term were searched recently.
+    """
+    key = (normalize_address(address), normalize_term(term), offset)
+
+    return yelp_search_cache.get_or_load(key, lambda: yelp_business_search(apikey, address, term, offset))
+
+
+####################################################################################
+# Yelp fan-out search
+#
+# Planning a date ("dinner, drinks, dessert") needs one Yelp search per interest and
+# page. They are sent concurrently from a small thread pool and merged into one payload.
+
+MAX_FANOUT_INTERESTS = 5
+MAX_FANOUT_PAGES = 4
+
+yelp_fanout_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="yelp-fanout")
+
+
+def yelp_multi_business_search(apikey, address, interests, pages=1):
+    """This method searches Yelp for several interests and/or several pages at once.
+
+       Page `n` of an interest starts at offset `n * YELP_PAGE_SIZE`. Businesses found by more
+       than one search are merged on their `yelp_id`, keeping the first position they were
+       found at and listing every interest that matched them.
+
+       It returns {"businesses": [...], "interests": [...], "failed": [...]} where `failed` lists
+       the interests with at least one page that could not be searched. ProviderUnavailable is
+       raised only when every search (every interest and page) failed.
+    """
+    terms = []
+    for interest in interests or []:
+        term = normalize_term(interest)
+        if term and term not in terms:
+            terms.append(term)
+
+    terms = terms[:MAX_FANOUT_INTERESTS]
+    pages = max(1, min(int(pages), MAX_FANOUT_PAGES))
+
+    searches = [(term, page * YELP_PAGE_SIZE) for term in terms for page in range(pages)]
+    futures = [yelp_fanout_pool.submit(cached_yelp_business_search, apikey, address, term, offset)
+               for term, offset in searches]
+
+    merged = OrderedDict()
+    failed = []
+    failures = 0
+    error = None
+
+    for (term, offset), future in zip(searches, futures):
+        try:
+            result = future.result()
+        except ProviderUnavailable as e:
+            error = e
+            failures += 1
+            if term not in failed:
+                failed.append(term)
+            continue
+
+        for biz in result["businesses"]:
+            if biz['yelp_id'] not in merged:
+                merged[biz['yelp_id']] = dict(biz, interests=[])
+            if term not in merged[biz['yelp_id']]['interests']:
+                merged[biz['yelp_id']]['interests'].append(term)
+
+    if searches and failures == len(searches):
+        raise error
+
+    return {"businesses": list(merged.values()), "interests": terms, "failed": failed}
+
+
+def yelp_cache_stats():
+    """This method reports the hit, miss and refresh counts of the Yelp search cache."""
+
+    return yelp_search_cache.stats()
+
+
 # def yelp_business_match(apikey, name, address):
 #     """This method makes the request to the Yelp API to retrieve a 
 #         particular business given the business name and address.
@@ -0,0 +1,98 @@
+"""This file holds the HTTP caching policy of the dateMeet app.
+
+Every response gets a Cache-Control header picked per route: pages and API responses
+depend on who is logged in, so by default they may only be kept by the browser and must
+be revalidated (`private, no-cache`). Views can choose another policy with `cache_policy`.
+Fingerprinted assets and resized images never change under the same URL, so they are
+served with long-lived, immutable caching. Files under /static/ keep their names when they
+change, so browsers may only reuse them for an hour before revalidating.
+
+Views whose output is fully described by a few row versions can answer revalidations with
+`conditional_render`, which compares the request's If-None-Match with a strong ETag and
+returns 304 Not Modified before the template is rendered.
+"""
+
+import hashlib
+import os
+import time
+
+from flask import current_app, make_response, request, session
+
+DEFAULT_CACHE_CONTROL = 'private, no-cache'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+STATIC_CACHE_CONTROL = 'public, max-age=3600, must-revalidate'
+
+# Flask's own static route is a bound method, so its policy can't be set with the decorator.
+STATIC_ENDPOINTS = {'static'}
+
+
+def init_http_caching(app):
+    """This function installs the per-route Cache-Control policy on the app.
+
+       ETAG_SALT is mixed into every ETag so that a deploy (which may change templates)
+       invalidates them. The prod profile sets it to the release's commit so all workers
+       agree on it; otherwise each worker uses its start time.
+    """
+
+    app.config['ETAG_SALT'] = app.config.get('ETAG_SALT') or os.environ.get('ETAG_SALT') or str(int(time.time()))
+    app.after_request(apply_cache_policy)
+
+
+def cache_policy(cache_control):
+    """This decorator sets the Cache-Control header used for responses of a view function.
+       It goes below `@app.route`.
+    """
+
+    def decorate(view):
+        view.cache_control = cache_control
+        return view
+
+    return decorate
+
+
+def apply_cache_policy(response):
+    """This function sets the Cache-Control header of `response` from the policy of its route."""
+
+    view = current_app.view_functions.get(request.endpoint)
+
+    if request.endpoint in STATIC_ENDPOINTS:
+        cache_control = STATIC_CACHE_CONTROL
+    else:
+        cache_control = getattr(view, 'cache_control', DEFAULT_CACHE_CONTROL)
+
+    # Errors (like a missing static file) and redirects must not be cached for long.
+    if not (200 <= response.status_code < 300 or response.status_code == 304):
+        cache_control = DEFAULT_CACHE_CONTROL
+
+    response.headers['Cache-Control'] = cache_control
+
+    return response
+
+
+def etag_for(*parts):
+    """This function returns a strong ETag for a page made from `parts` (ids, versions, ...)."""
+
+    key = repr((current_app.config['ETAG_SALT'],) + parts)
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def conditional_render(etag, render):
+    """This function returns 304 Not Modified if the client already has the page tagged
+       `etag`, and otherwise the response of `render()` tagged with it.
+
+       Pages with pending flash messages are always rendered, so the messages are shown.
+    """
+
+    if session.get('_flashes'):
+        return render()
+
+    # Weak comparison, since compression.py turns the ETags of compressed pages weak.
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag)
+
+    return response
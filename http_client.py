@@ -0,0 +1,301 @@
+"""This file holds the outbound HTTP client used for the Google and Yelp API calls.
+
+Every provider gets its own keep-alive connection pool, connect and read timeouts,
+a bounded number of retries with jittered backoff, a cap on how many requests it may
+have in flight at once and a circuit breaker that fails fast while the provider is down.
+
+The image proxy's client fetches from any host users link to, so it keeps one circuit
+breaker per host and only ever connects to public addresses.
+"""
+
+import ipaddress
+import random
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# How many hosts a per-host client keeps a circuit breaker for.
+MAX_HOST_BREAKERS = 1024
+
+
+class ProviderUnavailable(Exception):
+    """This exception is raised when a provider cannot be reached, either because its
+       circuit is open, all of its request slots are taken or every retry failed.
+    """
+
+
+class CircuitBreaker:
+    """This class holds a simple circuit breaker.
+
+       After `failure_threshold` consecutive failures the circuit opens and calls fail fast.
+       Once `reset_timeout` seconds have passed a single trial call is let through: if it
+       succeeds the circuit closes again, if it fails the circuit stays open.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """This method returns True when a call may be made to the provider."""
+
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+
+            return False
+
+    def record_success(self):
+        """This method closes the circuit after a successful call."""
+
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        """This method counts a failed call and opens the circuit when needed."""
+
+        with self._lock:
+            self.failures += 1
+
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+def is_public_address(address):
+    """This function checks that an IP address (as text) is on the public internet."""
+
+    return ipaddress.ip_address(address.split('%')[0]).is_global
+
+
+class PublicAddressError(Exception):
+    """This exception is raised when a public-only client connects to a private address.
+       It isn't an OSError, so urllib3 lets it through instead of retrying the connection.
+    """
+
+
+def check_peer(sock):
+    """This function closes `sock` and raises PublicAddressError unless it is connected
+       to a public address.
+    """
+
+    address = sock.getpeername()[0]
+
+    if not is_public_address(address):
+        sock.close()
+        raise PublicAddressError(f"refusing to talk to {address}")
+
+    return sock
+
+
+class PublicHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        return check_peer(super()._new_conn())
+
+
+class PublicHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+        return check_peer(super()._new_conn())
+
+
+class PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PublicHTTPConnection
+
+
+class PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PublicHTTPSConnection
+
+
+class PublicOnlyAdapter(HTTPAdapter):
+    """This class holds a transport adapter that checks the address every connection is
+       actually made to, so a host name that resolves to a private address (for instance
+       after it was checked, by DNS rebinding) can't be reached.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": PublicHTTPConnectionPool,
+                                                   "https": PublicHTTPSConnectionPool}
+
+
+class ProviderClient:
+    """This class holds the pooled, bounded HTTP client for one external provider.
+
+       With `per_host_breakers` every host gets its own circuit breaker, for clients that
+       talk to many unrelated hosts. With `public_only` the client refuses to connect to
+       addresses that aren't on the public internet, and ignores proxy settings.
+    """
+
+    def __init__(self, name, pool_size=10, max_concurrency=10, queue_timeout=2,
+                 connect_timeout=3.05, read_timeout=10, max_retries=2, backoff=0.25,
+                 failure_threshold=5, reset_timeout=30, per_host_breakers=False, public_only=False):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.queue_timeout = queue_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breaker = None if per_host_breakers else CircuitBreaker(failure_threshold, reset_timeout)
+        self._host_breakers = OrderedDict()
+        self._host_breakers_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.requests_made = 0
+        self.rejected = 0
+
+        adapter_class = PublicOnlyAdapter if public_only else HTTPAdapter
+        adapter = adapter_class(pool_connections=pool_size if per_host_breakers else 1,
+                                pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        if public_only:
+            # A proxy would be the peer of every connection, so proxies aren't used.
+            self.session.trust_env = False
+
+    def breaker_for(self, url):
+        """This method returns the circuit breaker for requests to `url`."""
+
+        if self.breaker is not None:
+            return self.breaker
+
+        host = urlparse(url).hostname or ''
+
+        with self._host_breakers_lock:
+            breaker = self._host_breakers.get(host)
+
+            if breaker is None:
+                breaker = self._host_breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+
+                if len(self._host_breakers) > MAX_HOST_BREAKERS:
+                    self._host_breakers.popitem(last=False)
+            else:
+                self._host_breakers.move_to_end(host)
+
+        return breaker
+
+    def get(self, url, params=None, headers=None, allow_redirects=True, stream=False):
+        """This method makes a GET request to the provider and returns the response.
+
+           Connection errors, timeouts and retryable status codes are retried with
+           jittered exponential backoff. ProviderUnavailable is raised when the
+           request could not be made or every attempt failed. With `stream` the body
+           isn't read yet, and the caller must close the response.
+        """
+
+        breaker = self.breaker_for(url)
+
+        # A slot is taken before asking the breaker, so a half open trial call is only
+        # started when it can actually be made.
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.rejected += 1
+            raise ProviderUnavailable(f"{self.name} has too many requests in flight")
+
+        try:
+            if not breaker.allow():
+                self.rejected += 1
+                raise ProviderUnavailable(f"{self.name} circuit is open")
+
+            recorded = False
+
+            try:
+                error = None
+
+                for attempt in range(self.max_retries + 1):
+                    if attempt:
+                        time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+                    self.requests_made += 1
+
+                    try:
+                        response = self.session.get(url, params=params, headers=headers, timeout=self.timeout,
+                                                    allow_redirects=allow_redirects, stream=stream)
+                    except PublicAddressError as e:
+                        # Asking again won't change where the host points.
+                        error = e
+                        break
+                    except (requests.ConnectionError, requests.Timeout) as e:
+                        error = e
+                        continue
+                    except requests.RequestException as e:
+                        # Bad URLs, redirect loops and broken bodies won't get better on retry.
+                        error = e
+                        break
+
+                    if response.status_code in RETRY_STATUSES:
+                        error = requests.HTTPError(f"{self.name} returned {response.status_code}", response=response)
+                        response.close()
+                        continue
+
+                    breaker.record_success()
+                    recorded = True
+                    return response
+
+                breaker.record_failure()
+                recorded = True
+                raise ProviderUnavailable(f"{self.name} request failed: {error}") from error
+
+            finally:
+                # Anything else that escaped still has to end a half open trial call.
+                if not recorded:
+                    breaker.record_failure()
+
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        """This method returns the counters and circuit state of this client as a dictionary."""
+
+        if self.breaker is None:
+            with self._host_breakers_lock:
+                breakers = list(self._host_breakers.items())
+
+            return {
+                "hosts": len(breakers),
+                "open_circuits": sorted(host for host, breaker in breakers if breaker.state != CircuitBreaker.CLOSED),
+                "requests_made": self.requests_made,
+                "rejected": self.rejected
+            }
+
+        return {
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "requests_made": self.requests_made,
+            "rejected": self.rejected
+        }
+
+
+google_client = ProviderClient("google", pool_size=10, max_concurrency=10, read_timeout=5)
+yelp_client = ProviderClient("yelp", pool_size=20, max_concurrency=20, read_timeout=8)
+# Source images for the image proxy (images.py), which can be on any host: one slow or
+# broken host must not turn the proxy off for every other one.
+image_client = ProviderClient("images", pool_size=10, max_concurrency=8, read_timeout=10, max_retries=1,
+                              per_host_breakers=True, public_only=True)
+
+
+def provider_stats():
+    """This function reports the state of every provider client."""
+
+    return {client.name: client.stats() for client in (google_client, yelp_client, image_client)}
@@ -0,0 +1,362 @@
+"""This file holds the image proxy used for user avatars and header images.
+
+Users can point image_url and header_url at any picture on the web, often a multi-megabyte
+original. Templates link them with `resized_image_url(url, size)` instead, which points at
+/images/<size>/<token>, where the token is the source URL signed with the app's secret key
+(so the proxy can't be used to fetch arbitrary URLs). The first request for an image
+fetches it once, crops and downsizes it to one of IMAGE_SIZES, re-encodes it as WebP (or
+JPEG for browsers without WebP) and saves it to a disk cache bounded by
+IMAGE_CACHE_MAX_BYTES. Later requests are served from disk with long-lived caching.
+
+When the source can't be fetched or read, the request is redirected to the default image.
+"""
+
+import hashlib
+import os
+import socket
+import tempfile
+import threading
+from io import BytesIO
+from urllib.parse import urljoin, urlparse
+
+import requests
+from flask import abort, current_app, redirect, request, safe_join, send_file, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+from werkzeug.exceptions import NotFound
+
+from assets import asset_url
+from http_caching import cache_policy, IMMUTABLE_CACHE_CONTROL
+from http_client import ProviderUnavailable, image_client, is_public_address
+
+# Width and height of every size, twice the size they are shown at for high density screens.
+IMAGE_SIZES = {
+    'avatar': (140, 140),     # timeline, navbar and user card avatars
+    'profile': (400, 400),    # the profile page avatar
+    'card': (600, 300),       # user card headers
+    'header': (1600, 720),    # the profile page header
+}
+
+DEFAULT_IMAGES = {
+    'avatar': 'blank-profile-picture.png',
+    'profile': 'blank-profile-picture.png',
+    'card': 'blank-header-picture.jpeg',
+    'header': 'blank-header-picture.jpeg',
+}
+
+# Pillow format, mimetype and save options of every output format.
+FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+# How many redirects a source URL may go through, each checked like the URL itself.
+MAX_SOURCE_REDIRECTS = 3
+
+
+class ImageUnavailable(Exception):
+    """This exception is raised when a source image can't be fetched or read."""
+
+
+class DiskImageCache:
+    """This class holds a directory of resized images bounded by their total size.
+
+       Files are named after a hash of what they were made from. Reading a file touches it,
+       so when the cache grows over `max_bytes` the least recently used files are removed
+       first. The running total is per worker, so it is recomputed from disk on eviction.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size_bytes = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """This method returns the path of the file saved under `key`, or None."""
+
+        path = self.path_for(key)
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return path
+
+    def put(self, key, data):
+        """This method saves `data` under `key` and returns its path."""
+
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Written under a temporary name first, so other workers never serve half a file.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if self._size_bytes is None:
+                self._size_bytes = sum(size for _, size, _ in self.files())
+
+            self._size_bytes += len(data)
+
+            if self._size_bytes > self.max_bytes:
+                self.evict()
+
+        return path
+
+    def files(self):
+        """This method returns (last used, size, path) for every file in the cache."""
+
+        files = []
+
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        return files
+
+    def evict(self):
+        """This method removes the least recently used files until the cache is under 90%
+           of its budget, so it doesn't have to evict again on the next write.
+        """
+
+        files = sorted(self.files())
+        total = sum(size for _, size, _ in files)
+
+        for _, size, path in files:
+            if total <= self.max_bytes * 0.9:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            total -= size
+            self.evictions += 1
+
+        self._size_bytes = total
+
+    def stats(self):
+        """This method returns the counters of this cache as a dictionary."""
+
+        return {
+            "size_bytes": self._size_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+def init_images(app):
+    """This function adds the image proxy route and the resized_image_url template function
+       to the app.
+    """
+
+    app.config.setdefault('IMAGE_CACHE_DIR', os.environ.get('IMAGE_CACHE_DIR',
+                                                           os.path.join(tempfile.gettempdir(), 'dateMeet-images')))
+    app.config.setdefault('IMAGE_CACHE_MAX_BYTES', int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024)))
+    app.config.setdefault('IMAGE_MAX_SOURCE_BYTES', 20 * 1024 * 1024)
+
+    app.extensions['image_cache'] = DiskImageCache(app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'])
+
+    app.add_url_rule('/images/<size>/<token>', 'resized_image', send_image)
+    app.add_template_global(resized_image_url)
+
+
+def image_serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='image-proxy')
+
+
+def resized_image_url(source, size):
+    """This function returns the URL of the image at `source` resized to `size`."""
+
+    if not source:
+        return asset_url(DEFAULT_IMAGES[size])
+
+    return url_for('resized_image', size=size, token=image_serializer().dumps(source))
+
+
+def image_cache_stats(app):
+    """This function returns the counters of the app's image cache."""
+
+    return app.extensions['image_cache'].stats()
+
+
+def is_public_host(hostname):
+    """This function checks that `hostname` only resolves to public addresses, so users
+       can't make the proxy fetch from our own network.
+
+       This only saves a request to hosts that are private anyway: the image client
+       checks the address it actually connects to, in case the name resolves differently
+       by then.
+    """
+
+    try:
+        addresses = socket.getaddrinfo(hostname, None)
+    except (socket.gaierror, UnicodeError):
+        return False
+
+    return all(is_public_address(address[4][0]) for address in addresses)
+
+
+def fetch_source(source):
+    """This function downloads the image at the URL `source` and returns its bytes.
+
+       Redirects are followed one at a time so every hop is checked before it is
+       fetched, and the body is read in chunks so a source over IMAGE_MAX_SOURCE_BYTES
+       is dropped as soon as it gets too large.
+    """
+
+    max_bytes = current_app.config['IMAGE_MAX_SOURCE_BYTES']
+    url = source
+
+    for _ in range(MAX_SOURCE_REDIRECTS + 1):
+        parsed = urlparse(url)
+
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname or not is_public_host(parsed.hostname):
+            raise ImageUnavailable(f"won't fetch {url}")
+
+        try:
+            resp = image_client.get(url, allow_redirects=False, stream=True)
+        except ProviderUnavailable as e:
+            raise ImageUnavailable(str(e)) from e
+
+        try:
+            if resp.is_redirect:
+                url = urljoin(url, resp.headers['Location'])
+                continue
+
+            if resp.status_code != 200:
+                raise ImageUnavailable(f"{url} returned {resp.status_code}")
+
+            if int(resp.headers.get('Content-Length') or 0) > max_bytes:
+                raise ImageUnavailable(f"{url} is {resp.headers['Content-Length']} bytes")
+
+            data = bytearray()
+
+            for chunk in resp.iter_content(64 * 1024):
+                data += chunk
+
+                if len(data) > max_bytes:
+                    raise ImageUnavailable(f"{url} is over {max_bytes} bytes")
+
+            return bytes(data)
+
+        except (requests.RequestException, ValueError) as e:
+            raise ImageUnavailable(f"can't read {url}: {e}") from e
+
+        finally:
+            resp.close()
+
+    raise ImageUnavailable(f"{source} redirected too many times")
+
+
+def load_source(source):
+    """This function returns the image at `source`, a URL or a path under /static/."""
+
+    if source.startswith('/static/'):
+        path = safe_join(current_app.static_folder, source[len('/static/'):])
+
+        try:
+            with open(path, 'rb') as source_file:
+                data = source_file.read()
+        except (OSError, TypeError, NotFound) as e:
+            raise ImageUnavailable(f"can't read {source}") from e
+    else:
+        data = fetch_source(source)
+
+    # Pillow is imported on first use, so workers that never resize an image don't load it.
+    from PIL import Image
+
+    try:
+        image = Image.open(BytesIO(data))
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ImageUnavailable(f"{source} is not an image") from e
+
+    return image
+
+
+def resize(image, size, output_format):
+    """This function returns `image` cropped and scaled to `size`, encoded as `output_format`."""
+
+    from PIL import Image, ImageOps
+
+    width, height = IMAGE_SIZES[size]
+    pil_format, _, options = FORMATS[output_format]
+
+    try:
+        # JPEGs are decoded at the smallest scale that is still large enough, which is much
+        # faster than decoding the whole original.
+        image.draft('RGB', (width, height))
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+
+            if pil_format == 'JPEG':
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+        else:
+            image = image.convert('RGB')
+
+        image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+
+        output = BytesIO()
+        image.save(output, pil_format, **options)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageUnavailable(f"can't resize image: {e}") from e
+
+    return output.getvalue()
+
+
+@cache_policy(IMMUTABLE_CACHE_CONTROL)
+def send_image(size, token):
+    """This view function serves a resized image, making it on the first request."""
+
+    if size not in IMAGE_SIZES:
+        abort(404)
+
+    try:
+        source = image_serializer().loads(token)
+    except BadSignature:
+        abort(404)
+
+    # Browsers that can show WebP say so explicitly; */* alone isn't enough.
+    accepts_webp = any(mimetype == 'image/webp' and quality for mimetype, quality in request.accept_mimetypes)
+    output_format = 'webp' if accepts_webp else 'jpeg'
+    key = hashlib.sha256(f"{source}\n{size}\n{output_format}".encode('utf-8')).hexdigest()
+
+    cache = current_app.extensions['image_cache']
+    path = cache.get(key)
+
+    if path is None:
+        try:
+            data = resize(load_source(source), size, output_format)
+        except ImageUnavailable as e:
+            current_app.logger.info("Image proxy: %s", e)
+            return redirect(asset_url(DEFAULT_IMAGES[size]))
+
+        path = cache.put(key, data)
+
+    response = send_file(path, mimetype=FORMATS[output_format][1], conditional=True)
+    response.vary.add('Accept')
+
+    return response
@@ -0,0 +1,49 @@
+"""This file holds the request globals (`g`) class used by the dateMeet app.
+
+Attributes registered with `LazyGlobals.loader` (e.g. g.user and g.location) are only
+loaded the first time they are read during a request, then memoized for the rest of it.
+Requests that never read them, like static files, don't run their queries at all.
+"""
+
+from flask.ctx import _AppCtxGlobals
+
+
+class LazyGlobals(_AppCtxGlobals):
+    """This class is a Flask `g` object whose registered attributes load on first access."""
+
+    loaders = {}
+
+    @classmethod
+    def loader(cls, name):
+        """This decorator registers a function (taking no arguments) that loads `g.<name>`."""
+
+        def register(func):
+            cls.loaders[name] = func
+            return func
+
+        return register
+
+    def __getattr__(self, name):
+        loader = type(self).loaders.get(name)
+
+        if loader is None:
+            raise AttributeError(name)
+
+        value = loader()
+        setattr(self, name, value)
+
+        return value
+
+    def get(self, name, default=None):
+        """This method returns `g.<name>`, loading it if it is a lazy attribute, or `default`."""
+
+        if name in self.__dict__ or name in type(self).loaders:
+            return getattr(self, name)
+
+        return default
+
+    def reset(self):
+        """This method forgets the loaded lazy attributes so they are loaded again on next access."""
+
+        for name in type(self).loaders:
+            self.__dict__.pop(name, None)
@@ -1,13 +1,36 @@
 """SQLAlchemy models for the dateMeet app"""
 
 import datetime 
+import math
 
-from flask_bcrypt import Bcrypt 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, Float, cast, event, extract, func, literal, or_
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert
+from sqlalchemy.orm import defer, make_transient_to_detached
+
+from geo import EARTH_RADIUS_KM, GEOHASH_PRECISION, covering_cells, encode_geohash
+from pagination import Page, keyset_page, merge_pages
+from passwords import check_password, hash_password, needs_rehash
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+SEARCH_CONFIG = 'english'
+
+# Authors with more followers than this are not fanned out to their followers' timelines.
+FANOUT_MAX_FOLLOWERS = 10000
+# How many recent recommendations of an author are added to a timeline on follow.
+TIMELINE_BACKFILL = 50
+
+# Trending scores: the weight of a like halves every TRENDING_HALF_LIFE_HOURS.
+# TRENDING_TOP_K recommendations are shown per city and TRENDING_KEEP are kept by
+# `flask reconcile-trending`, which only counts likes from the last TRENDING_WINDOW_DAYS.
+# Run it daily (on Heroku with the Scheduler add-on) so old likes stop counting.
+TRENDING_EPOCH = datetime.datetime(2021, 1, 1)
+TRENDING_HALF_LIFE_HOURS = 24
+TRENDING_TOP_K = 20
+TRENDING_KEEP = 200
+TRENDING_WINDOW_DAYS = 14
+
 
 class Follows(db.Model):
     """This class holds the structure of the follows table for the dateMeet app.
@@ -34,6 +57,25 @@ class Follows(db.Model):
                         primary_key=True,
     )
 
+    # True while the followed user has more than FANOUT_MAX_FOLLOWERS followers, so their
+    # recommendations are merged into this follower's timeline when it is read.
+    pulled = db.Column(
+             db.Boolean,
+             nullable=False,
+             default=False,
+             server_default=db.false()
+    )
+
+    # These indexes let "who does this user follow" and "who follows this user"
+    # lookups (and the batched follow state checks) run as index scans. The partial
+    # index holds only the pulled follows, which timeline reads look up.
+    __table_args__ = (
+        db.Index('ix_follows_following_followed', 'user_following_id', 'user_being_followed_id', unique=True),
+        db.Index('ix_follows_followed_following', 'user_being_followed_id', 'user_following_id'),
+        db.Index('ix_follows_following_pulled', 'user_following_id', 'user_being_followed_id',
+                 postgresql_where=db.text('pulled')),
+    )
+
 # Note that the follows table has two foreign keys to the same table user, 
 # This is because each of these foreigns keys track data in two scenarios
 # While user_being_followed holds data of the other users a current user is following,
@@ -101,28 +143,86 @@ class User(db.Model):
                  default=datetime.datetime.now
     )
 
+    # These counters are kept up to date when Follows, Likes and Recommendation rows are
+    # added or deleted (see the mapper events at the bottom of this file), so profile pages
+    # don't have to load whole collections to count them.
+    # `flask reconcile-counters` repairs them if they ever drift.
+
+    recommendation_count = db.Column(
+                           db.Integer,
+                           nullable=False,
+                           default=0,
+                           server_default='0'
+    )
+
+    following_count = db.Column(
+                      db.Integer,
+                      nullable=False,
+                      default=0,
+                      server_default='0'
+    )
+
+    followers_count = db.Column(
+                      db.Integer,
+                      nullable=False,
+                      default=0,
+                      server_default='0'
+    )
+
+    likes_count = db.Column(
+                  db.Integer,
+                  nullable=False,
+                  default=0,
+                  server_default='0'
+    )
+
+    # Bumped whenever a field shown on recommendation cards changes (see the mapper events
+    # at the bottom of this file), so cached cards keyed on it are never served stale.
+    version = db.Column(
+              db.Integer,
+              nullable=False,
+              default=1,
+              server_default='1'
+    )
+
+
+    # The location the user entered or edited last. The homepage resolves it with a
+    # primary key lookup instead of searching the user's locations. The foreign key is
+    # added after both tables exist, since locations also points back to users.
+    current_location_id = db.Column(
+                          db.Integer,
+                          db.ForeignKey('locations.id', ondelete='SET NULL', use_alter=True,
+                                        name='fk_users_current_location_id'),
+                          nullable=True
+    )
 
-    locations = db.relationship('Location', backref='users')
+    locations = db.relationship('Location', backref='users', foreign_keys='Location.user_id')
 
     recommendations  = db.relationship('Recommendation', backref='user')
 
+    # These three are read only: follows and likes are written through the Follows and
+    # Likes models (or Likes.toggle), whose events keep the counters, timelines and
+    # trending scores up to date. Appending to them would skip those events.
     followers = db.relationship(
                 "User",
                 secondary="follows",
                 primaryjoin=(Follows.user_being_followed_id == id),
-                secondaryjoin=(Follows.user_following_id == id)
+                secondaryjoin=(Follows.user_following_id == id),
+                viewonly=True
     )
 
     following = db.relationship(
                 "User",
                 secondary="follows",
                 primaryjoin=(Follows.user_following_id == id),
-                secondaryjoin=(Follows.user_being_followed_id == id)
+                secondaryjoin=(Follows.user_being_followed_id == id),
+                viewonly=True
     )
 
     likes = db.relationship(
             "Recommendation",
-            secondary="likes"
+            secondary="likes",
+            viewonly=True
     )
 
     # history = db.relationship('History', backref='users')
@@ -138,14 +238,143 @@ class User(db.Model):
     def is_following(self, other_user):
         """This method checks if the signed in user is following `other_user`"""
 
-        user_following_list = [user for user in self.following if user == other_user]
-        return len(user_following_list) == 1
+        return other_user.id in self.following_ids_among([other_user.id])
 
     def is_followed_by(self, other_user):
         """This method checks if the signed in user is being followed by `other_user`"""
 
-        user_followed_by_list = [user for user in self.followers if user == other_user]
-        return len(user_followed_by_list) == 1
+        return other_user.id in self.follower_ids_among([other_user.id])
+
+    def following_ids_among(self, user_ids):
+        """This method returns the set of ids in `user_ids` that this user is following,
+           using one indexed query.
+        """
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(set(user_ids)))
+                .all())
+
+        return {row[0] for row in rows}
+
+    def follower_ids_among(self, user_ids):
+        """This method returns the set of ids in `user_ids` that are following this user,
+           using one indexed query.
+        """
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_following_id)
+                .filter(Follows.user_being_followed_id == self.id,
+                        Follows.user_following_id.in_(set(user_ids)))
+                .all())
+
+        return {row[0] for row in rows}
+
+    def liked_ids_among(self, recommendation_ids):
+        """This method returns the set of ids in `recommendation_ids` that this user liked,
+           using one query on the (user_id, recommendation_id) unique index.
+        """
+
+        if not recommendation_ids:
+            return set()
+
+        rows = (db.session
+                .query(Likes.recommendation_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.recommendation_id.in_(set(recommendation_ids)))
+                .all())
+
+        return {row[0] for row in rows}
+
+    def following_page(self, cursor=None, per_page=50):
+        """This method returns a Page of the users this user is following.
+
+           Pages are fetched by keyset on follows.user_being_followed_id, which the
+           (user_following_id, user_being_followed_id) index returns in order.
+        """
+
+        query = (User.query
+                 .options(defer('password'))
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == self.id))
+
+        return keyset_page(query, [Follows.user_being_followed_id], cursor, per_page, key=lambda user: [user.id])
+
+    def followers_page(self, cursor=None, per_page=50):
+        """This method returns a Page of the users following this user, by keyset on
+           follows.user_following_id.
+        """
+
+        query = (User.query
+                 .options(defer('password'))
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == self.id))
+
+        return keyset_page(query, [Follows.user_following_id], cursor, per_page, key=lambda user: [user.id])
+
+    def likes_page(self, cursor=None, per_page=50):
+        """This method returns a Page of the recommendations this user liked, newest
+           recommendation first, with their authors loaded in the same query.
+        """
+
+        query = (Recommendation.query
+                 .options(db.joinedload('user'))
+                 .join(Likes, Likes.recommendation_id == Recommendation.id)
+                 .filter(Likes.user_id == self.id))
+
+        return keyset_page(query, [Likes.recommendation_id], cursor, per_page,
+                           key=lambda recommendation: [recommendation.id])
+
+    def latest_location_id(self):
+        """This method returns the id of the location this user entered last, or None."""
+
+        return (db.session
+                .query(Location.id)
+                .filter(Location.user_id == self.id)
+                .order_by(Location.id.desc())
+                .limit(1)
+                .scalar())
+
+    def snapshot(self):
+        """This method returns the column values of the user, for caching outside the session.
+
+           The password hash is left out, so it never sits in a cache; a user made from the
+           snapshot loads it from the db if it is ever read.
+        """
+
+        return {column.key: getattr(self, column.key) for column in db.inspect(User).column_attrs
+                if column.key != 'password'}
+
+    @classmethod
+    def from_snapshot(cls, values):
+        """This class method attaches a user saved with `snapshot` to the current session
+           without querying the db. Relationships still load lazily as usual.
+        """
+
+        user = cls(**values)
+        make_transient_to_detached(user)
+
+        return db.session.merge(user, load=False)
+
+    def serialize(self):
+        """This method returns the public details of the user as a dictionary for the JSON api."""
+
+        p = self
+
+        return {
+            "id": p.id,
+            "username": p.username,
+            "full_name": p.full_name(),
+            "image_url": p.image_url,
+            "bio": p.bio
+        }
 
     def full_name(self):
         """This method formats the first and last anme to form a full name"""
@@ -160,7 +389,7 @@ class User(db.Model):
            It hashes the entered user password and adds the new user to the system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(
                 first_name=first_name,
@@ -175,6 +404,86 @@ class User(db.Model):
         db.session.add(user)
         return user
     
+    def release_counters(self):
+        """This method takes this user out of the counters of every other user (and of the
+           recommendations they liked), before the user is deleted and their follows and
+           likes are removed with them.
+        """
+
+        users = User.__table__
+        follows = Follows.__table__
+        likes = Likes.__table__
+        recommendations = Recommendation.__table__
+
+        followed = (db.select([follows.c.user_being_followed_id.label('user_id'), func.count().label('n')])
+                    .where(follows.c.user_following_id == self.id)
+                    .group_by(follows.c.user_being_followed_id)
+                    .alias())
+
+        followers = (db.select([follows.c.user_following_id.label('user_id'), func.count().label('n')])
+                     .where(follows.c.user_being_followed_id == self.id)
+                     .group_by(follows.c.user_following_id)
+                     .alias())
+
+        likers = (db.select([likes.c.user_id, func.count().label('n')])
+                  .select_from(likes.join(recommendations, likes.c.recommendation_id == recommendations.c.id))
+                  .where(recommendations.c.user_id == self.id)
+                  .group_by(likes.c.user_id)
+                  .alias())
+
+        db.session.execute(users.update()
+                           .where(users.c.id == followed.c.user_id)
+                           .values(followers_count=users.c.followers_count - followed.c.n))
+        db.session.execute(users.update()
+                           .where(users.c.id == followers.c.user_id)
+                           .values(following_count=users.c.following_count - followers.c.n))
+        db.session.execute(users.update()
+                           .where(users.c.id == likers.c.user_id)
+                           .values(likes_count=users.c.likes_count - likers.c.n))
+        db.session.execute(recommendations.update()
+                           .where(recommendations.c.id.in_(db.select([likes.c.recommendation_id])
+                                                           .where(likes.c.user_id == self.id)))
+                           .values(likes_count=recommendations.c.likes_count - 1))
+
+    @classmethod
+    def reconcile_counters(cls):
+        """This class method recounts the follower, following, like and recommendation counters
+           of every user from the follows, likes and recommendations tables.
+
+           It returns the number of users whose counters had drifted.
+        """
+
+        users = User.__table__
+        follows = Follows.__table__
+        likes = Likes.__table__
+        recommendations = Recommendation.__table__
+
+        counts = {
+            users.c.recommendation_count: (db.select([func.count()])
+                                           .where(recommendations.c.user_id == users.c.id)
+                                           .as_scalar()),
+            users.c.following_count: (db.select([func.count()])
+                                      .where(follows.c.user_following_id == users.c.id)
+                                      .as_scalar()),
+            users.c.followers_count: (db.select([func.count()])
+                                      .where(follows.c.user_being_followed_id == users.c.id)
+                                      .as_scalar()),
+            users.c.likes_count: (db.select([func.count()])
+                                  .where(likes.c.user_id == users.c.id)
+                                  .as_scalar())
+        }
+
+        drifted = or_(*[column != count for column, count in counts.items()])
+        result = db.session.execute(users.update().where(drifted).values(counts))
+
+        # The pulled flags follow the recounted follower counts.
+        pulled = (db.select([users.c.followers_count > FANOUT_MAX_FOLLOWERS])
+                  .where(users.c.id == follows.c.user_being_followed_id)
+                  .as_scalar())
+        db.session.execute(follows.update().where(follows.c.pulled != pulled).values(pulled=pulled))
+
+        return result.rowcount
+
     @classmethod
     def authenticate(cls, username, password):
         """ This class method searches the db with the `username` and `password`
@@ -183,19 +492,82 @@ class User(db.Model):
 
             If this user is found in the db,  this method returns the user
             if not, it returns False.
+
+            A password hashed with an older work factor is rehashed with the current
+            one; the caller's next commit saves it.
         """
 
         user = cls.query.filter_by(username=username).first()
 
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = check_password(user.password, password)
 
             if is_auth:
+                if needs_rehash(user.password):
+                    user.password = hash_password(password)
+
                 return user
 
         return False 
 
+    @classmethod
+    def search_text(cls):
+        """This class method returns the lowercased "username first_name last_name" expression
+           that the users trigram index is built on.
+        """
+
+        return func.lower(cls.username + ' ' + cls.first_name + ' ' + cls.last_name)
+
+    @classmethod
+    def search(cls, term, cursor=None, per_page=60):
+        """This class method returns a Page of the users whose username or full name
+           contains `term`, most similar first.
+
+           The ILIKE-style match is served by the trigram index on `search_text`, and
+           password hashes are not loaded.
+        """
+
+        term = term.strip().lower()
+        search_text = cls.search_text()
+        rank = cast(func.greatest(func.similarity(func.lower(cls.username), term),
+                                  func.similarity(search_text, term)), Float).label('search_rank')
+
+        query = (db.session
+                 .query(cls, rank)
+                 .options(defer('password'))
+                 .filter(search_text.like(f"%{escape_like(term)}%", escape='\\')))
+
+        page = keyset_page(query, [rank, cls.id], cursor, per_page,
+                           key=lambda row: [row[1], row[0].id])
+
+        return Page([row[0] for row in page.items], page.next_cursor)
+
+    @classmethod
+    def directory(cls, cursor=None, per_page=60):
+        """This class method returns a Page of all users, newest first, without their password hashes."""
+
+        return keyset_page(cls.query.options(defer('password')), [cls.id], cursor, per_page)
+
+    @classmethod
+    def typeahead(cls, prefix, limit=10):
+        """This class method returns (id, username, image_url) rows for up to `limit` users
+           whose username starts with `prefix`, using the lower(username) prefix index.
+        """
+
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+
+        username = func.lower(cls.username)
+
+        return (db.session
+                .query(cls.id, cls.username, cls.image_url)
+                .filter(username.like(f"{escape_like(prefix)}%", escape='\\'))
+                .order_by(username)
+                .limit(limit)
+                .all())
+
 
 class Location(db.Model):
     """This class holds the structure of the locations table in the dateMeet db."""
@@ -247,7 +619,8 @@ class Location(db.Model):
     user_id = db.Column(
               db.Integer,
               db.ForeignKey('users.id', ondelete='CASCADE'),
-              nullable=False
+              nullable=False,
+              index=True
     )
 
     def __repr__(self):
@@ -309,6 +682,50 @@ class Recommendation(db.Model):
                       nullable=False
     )
 
+    # Kept up to date as likes are added and removed (see like_added / like_removed),
+    # so feeds can show and sort by it without counting likes.
+    likes_count = db.Column(
+                  db.Integer,
+                  nullable=False,
+                  default=0,
+                  server_default='0'
+    )
+
+    # Bumped whenever the recommendation is edited (see the mapper events at the bottom
+    # of this file). Rendered cards are cached under it, see fragment_cache.py.
+    version = db.Column(
+              db.Integer,
+              nullable=False,
+              default=1,
+              server_default='1'
+    )
+
+    # Coordinates of the business, geocoded when the recommendation is created.
+    # business_geohash is indexed so radius queries only scan nearby cells.
+
+    business_lat = db.Column(
+                   db.Float,
+                   nullable=True
+    )
+
+    business_long = db.Column(
+                    db.Float,
+                    nullable=True
+    )
+
+    business_geohash = db.Column(
+                       db.String(GEOHASH_PRECISION),
+                       nullable=True
+    )
+
+    # Weighted full text document (title and business name A, content B), kept up to date
+    # by the mapper events at the bottom of this file and indexed with GIN for `search`.
+    # It is deferred because only the search query needs it.
+    search_vector = db.deferred(db.Column(
+                    TSVECTOR,
+                    nullable=True
+    ))
+
     created_on = db.Column(
                  db.DateTime, 
                  nullable=False, 
@@ -321,6 +738,18 @@ class Recommendation(db.Model):
               nullable=False
     )
 
+    __table_args__ = (
+        db.Index('ix_recommendations_business_geohash', 'business_geohash',
+                 postgresql_ops={'business_geohash': 'text_pattern_ops'}),
+        # These indexes back the keyset paginated city feed and user profile pages.
+        db.Index('ix_recommendations_city_state_created_on', 'business_city', 'business_state', 'created_on', 'id'),
+        db.Index('ix_recommendations_user_created_on', 'user_id', 'created_on', 'id'),
+        db.Index('ix_recommendations_search_vector', 'search_vector', postgresql_using='gin'),
+        # These indexes back the "popular" and "top rated" orders of the city feed.
+        db.Index('ix_recommendations_city_state_likes_count', 'business_city', 'business_state', 'likes_count', 'id'),
+        db.Index('ix_recommendations_city_state_rating', 'business_city', 'business_state', 'business_rating', 'created_on', 'id'),
+    )
+
 
     def __repr__(self):
         """This method returns a clearer representation of the current post instance."""
@@ -329,6 +758,136 @@ class Recommendation(db.Model):
 
         return f"<title = {p.title} created_on = {p.created_on}>"
 
+    def serialize(self):
+        """This method returns the recommendation (and its author) as a dictionary for the JSON api."""
+
+        p = self
+
+        return {
+            "id": p.id,
+            "title": p.title,
+            "content": p.content,
+            "business_name": p.business_name,
+            "business_address": p.business_address,
+            "business_city": p.business_city,
+            "business_state": p.business_state,
+            "business_country": p.business_country,
+            "business_rating": p.business_rating,
+            "likes_count": p.likes_count,
+            "created_on": p.created_on.isoformat(),
+            "user": {
+                "id": p.user.id,
+                "username": p.user.username,
+                "image_url": p.user.image_url
+            }
+        }
+
+    def set_coordinates(self, lat, long):
+        """This method saves the coordinates of the business and the geohash used to index them."""
+
+        self.business_lat = lat
+        self.business_long = long
+        self.business_geohash = encode_geohash(lat, long)
+
+    @staticmethod
+    def search_document(title, content, business_name):
+        """This static method returns the SQL expression building the weighted tsvector
+           of a recommendation from its title, content and business name (columns or values).
+        """
+
+        def weighted(text, weight):
+            return func.setweight(func.to_tsvector(SEARCH_CONFIG, func.coalesce(text, '')), weight)
+
+        return weighted(title, 'A').op('||')(weighted(business_name, 'A')).op('||')(weighted(content, 'B'))
+
+    @classmethod
+    def search(cls, terms, city=None, state=None, min_rating=None, cursor=None, per_page=20):
+        """This class method returns a Page of the recommendations matching `terms`, best
+           match first, optionally limited to a city, a state and a minimum rating.
+
+           Matching uses the GIN index on search_vector and ranking uses ts_rank_cd,
+           so recommendations that mention the terms close together rank higher.
+        """
+
+        query_terms = func.plainto_tsquery(SEARCH_CONFIG, terms)
+        rank = cast(func.ts_rank_cd(cls.search_vector, query_terms), Float).label('search_rank')
+
+        query = (db.session
+                 .query(cls, rank)
+                 .options(db.joinedload('user'))
+                 .filter(cls.search_vector.op('@@')(query_terms)))
+
+        if city:
+            query = query.filter(func.lower(cls.business_city) == city.strip().lower())
+        if state:
+            query = query.filter(func.lower(cls.business_state) == state.strip().lower())
+        if min_rating:
+            query = query.filter(cls.business_rating >= min_rating)
+
+        page = keyset_page(query, [rank, cls.id], cursor, per_page,
+                           key=lambda row: [row[1], row[0].id])
+
+        return Page([row[0] for row in page.items], page.next_cursor)
+
+    @classmethod
+    def reconcile_counters(cls):
+        """This class method recounts the likes_count of every recommendation from the likes
+           table and returns the number of recommendations whose count had drifted.
+        """
+
+        recommendations = cls.__table__
+        likes = Likes.__table__
+
+        count = (db.select([func.count()])
+                 .where(likes.c.recommendation_id == recommendations.c.id)
+                 .as_scalar())
+
+        result = db.session.execute(recommendations.update()
+                                    .where(recommendations.c.likes_count != count)
+                                    .values(likes_count=count))
+
+        return result.rowcount
+
+    @classmethod
+    def reindex(cls):
+        """This class method rebuilds the search_vector of every recommendation and
+           returns the number of rows updated.
+        """
+
+        recommendations = cls.__table__
+        result = db.session.execute(recommendations.update().values(
+            search_vector=cls.search_document(recommendations.c.title,
+                                              recommendations.c.content,
+                                              recommendations.c.business_name)))
+
+        return result.rowcount
+
+    @classmethod
+    def within_radius(cls, lat, long, radius_km, limit=100):
+        """This class method returns up to `limit` recommendations within `radius_km` of
+           (lat, long), closest first, as a list of (recommendation, distance_km) tuples.
+
+           Only the geohash cells around the point are scanned, using the 
+           business_geohash index; the exact distance is then computed in the db.
+        """
+
+        d_lat = func.radians(cls.business_lat - lat) / 2
+        d_long = func.radians(cls.business_long - long) / 2
+        a = (func.power(func.sin(d_lat), 2)
+             + math.cos(math.radians(lat)) * func.cos(func.radians(cls.business_lat)) * func.power(func.sin(d_long), 2))
+        distance = 2 * EARTH_RADIUS_KM * func.asin(func.least(1.0, func.sqrt(a)))
+
+        cells = covering_cells(lat, long, radius_km)
+
+        return (db.session
+                .query(cls, distance.label('distance_km'))
+                .options(db.joinedload('user'))
+                .filter(or_(*[cls.business_geohash.like(f"{cell}%") for cell in cells]))
+                .filter(distance <= radius_km)
+                .order_by(distance, cls.id)
+                .limit(limit)
+                .all())
+
 
 class Likes(db.Model):
     """This class holds the structure of the likes table in the dateMeet db."""
@@ -352,6 +911,20 @@ class Likes(db.Model):
               db.ForeignKey('recommendations.id', ondelete='CASCADE')
     )
 
+    liked_on = db.Column(
+               db.DateTime,
+               nullable=False,
+               default=datetime.datetime.now,
+               server_default=func.now()
+    )
+
+    # A user can like a recommendation only once, which is what lets the like
+    # toggle below be a single conditional DELETE or INSERT.
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'recommendation_id', name='uq_likes_user_recommendation'),
+        db.Index('ix_likes_recommendation_id', 'recommendation_id'),
+    )
+
     def __repr__(self):
         """This method returns a clearer representation of the current post instance."""
 
@@ -359,6 +932,631 @@ class Likes(db.Model):
 
         return f"<user_id = {p.user_id} recommendation_id={p.recommendation_id}>"
 
+    @classmethod
+    def toggle(cls, user_id, recommendation_id):
+        """This class method unlikes a recommendation the user already likes and likes
+           it otherwise, without loading the user's likes.
+
+           The unlike is a single DELETE ... RETURNING; when it deletes nothing the like
+           is a single INSERT ... ON CONFLICT DO NOTHING, so two clicks racing each other
+           cannot create a duplicate row. It returns True when the recommendation is now liked.
+        """
+
+        likes = cls.__table__
+        connection = db.session.connection()
+
+        unliked = connection.execute(likes.delete()
+                                     .where(likes.c.user_id == user_id)
+                                     .where(likes.c.recommendation_id == recommendation_id)
+                                     .returning(likes.c.liked_on)).first()
+
+        # These statements bypass the Likes mapper events, so their work is done here.
+        if unliked:
+            like_removed(connection, user_id, recommendation_id, unliked.liked_on)
+            return False
+
+        liked = connection.execute(insert(likes)
+                                   .values(user_id=user_id, recommendation_id=recommendation_id)
+                                   .on_conflict_do_nothing(index_elements=['user_id', 'recommendation_id'])
+                                   .returning(likes.c.liked_on)).first()
+
+        if liked:
+            like_added(connection, user_id, recommendation_id, liked.liked_on)
+
+        return True
+
+
+
+class TimelineEntry(db.Model):
+    """This class holds the structure of the timeline_entries table in the dateMeet db.
+
+       Every row puts a recommendation on the home timeline of one of its author's followers.
+       Rows are written when the recommendation is added (fan-out on write), except for
+       authors with more than FANOUT_MAX_FOLLOWERS followers: their recommendations are
+       merged in when a timeline is read instead.
+    """
+
+    __tablename__ = "timeline_entries"
+
+    user_id = db.Column(
+              db.Integer,
+              db.ForeignKey('users.id', ondelete='CASCADE'),
+              primary_key=True
+    )
+
+    recommendation_id = db.Column(
+                        db.Integer,
+                        db.ForeignKey('recommendations.id', ondelete='CASCADE'),
+                        primary_key=True
+    )
+
+    author_id = db.Column(
+                db.Integer,
+                db.ForeignKey('users.id', ondelete='CASCADE'),
+                nullable=False
+    )
+
+    # Copied from the recommendation so a timeline page is one range scan of the index below.
+    created_on = db.Column(
+                 db.DateTime,
+                 nullable=False
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_created_on', 'user_id', 'created_on', 'recommendation_id'),
+        db.Index('ix_timeline_entries_recommendation_id', 'recommendation_id'),
+    )
+
+    def __repr__(self):
+        """This method returns a clearer representation of the current timeline entry instance."""
+
+        p = self
+
+        return f"<user_id = {p.user_id} recommendation_id = {p.recommendation_id} created_on = {p.created_on}>"
+
+    @classmethod
+    def fan_out(cls, recommendation):
+        """This class method adds a new recommendation to the timeline of every follower of
+           its author, with one INSERT ... SELECT, and returns the number of rows written.
+
+           Nothing is written for authors with more than FANOUT_MAX_FOLLOWERS followers.
+        """
+
+        if recommendation.user.followers_count > FANOUT_MAX_FOLLOWERS:
+            return 0
+
+        follows = Follows.__table__
+        followers = (db.select([follows.c.user_following_id,
+                                literal(recommendation.id, db.Integer),
+                                literal(recommendation.user_id, db.Integer),
+                                literal(recommendation.created_on, db.DateTime)])
+                     .where(follows.c.user_being_followed_id == recommendation.user_id))
+
+        result = db.session.execute(insert(cls.__table__)
+                                    .from_select(['user_id', 'recommendation_id', 'author_id', 'created_on'], followers)
+                                    .on_conflict_do_nothing())
+
+        return result.rowcount
+
+    @classmethod
+    def page_for(cls, user, cursor=None, per_page=50):
+        """This class method returns a Page of the recommendations made by the users `user`
+           follows, newest first.
+
+           The materialized entries are read with one range scan of the timeline index.
+           The followed authors that are not fanned out are found in the partial index of
+           pulled follows (usually empty), and their recent recommendations are fetched
+           with the same cursor and merged in.
+        """
+
+        query = (Recommendation.query
+                 .options(db.joinedload('user'))
+                 .join(cls, cls.recommendation_id == Recommendation.id)
+                 .filter(cls.user_id == user.id))
+
+        key = lambda recommendation: [recommendation.created_on, recommendation.id]
+        page = keyset_page(query, [cls.created_on, cls.recommendation_id], cursor, per_page, key=key)
+
+        pulled_author_ids = [row[0] for row in (db.session
+                                                .query(Follows.user_being_followed_id)
+                                                .filter(Follows.user_following_id == user.id, Follows.pulled))]
+
+        if not pulled_author_ids:
+            return page
+
+        query = (Recommendation.query
+                 .options(db.joinedload('user'))
+                 .filter(Recommendation.user_id.in_(pulled_author_ids)))
+
+        pulled = keyset_page(query, [Recommendation.created_on, Recommendation.id], cursor, per_page)
+
+        return merge_pages([page, pulled], per_page, key)
+
+
+class TrendingRecommendation(db.Model):
+    """This class holds the structure of the trending_recommendations table in the dateMeet db.
+
+       Every like adds exp((liked_on - TRENDING_EPOCH) / tau) to the score of a
+       recommendation, so older likes weigh less than newer ones (they halve every
+       TRENDING_HALF_LIFE_HOURS). Scores are stored as logarithms so they never overflow,
+       and since every score decays at the same rate they never need to be recomputed
+       as time passes. Likes update scores incrementally; `reconcile` rebuilds the table
+       from recent likes and drops everything outside each city's top TRENDING_KEEP.
+    """
+
+    __tablename__ = "trending_recommendations"
+
+    recommendation_id = db.Column(
+                        db.Integer,
+                        db.ForeignKey('recommendations.id', ondelete='CASCADE'),
+                        primary_key=True
+    )
+
+    business_city = db.Column(
+                    db.Text,
+                    nullable=False
+    )
+
+    business_state = db.Column(
+                     db.Text,
+                     nullable=False
+    )
+
+    score = db.Column(
+            db.Float,
+            nullable=False
+    )
+
+    __table_args__ = (
+        db.Index('ix_trending_recommendations_city_state_score', 'business_city', 'business_state', 'score'),
+    )
+
+    def __repr__(self):
+        """This method returns a clearer representation of the current trending instance."""
+
+        p = self
+
+        return f"<recommendation_id = {p.recommendation_id} score = {p.score}>"
+
+    @staticmethod
+    def like_weight(liked_on):
+        """This static method returns the log weight of a like made at `liked_on`."""
+
+        tau = TRENDING_HALF_LIFE_HOURS * 3600 / math.log(2)
+
+        return (liked_on - TRENDING_EPOCH).total_seconds() / tau
+
+    @classmethod
+    def add_like(cls, connection, recommendation_id, liked_on):
+        """This class method adds a like to the score of a recommendation."""
+
+        trending = cls.__table__
+        recommendations = Recommendation.__table__
+        weight = cls.like_weight(liked_on)
+
+        # log(e^a + e^b) computed without overflowing: max(a, b) + log(1 + e^-|a - b|)
+        upsert = insert(trending).from_select(
+            ['recommendation_id', 'business_city', 'business_state', 'score'],
+            db.select([recommendations.c.id,
+                       recommendations.c.business_city,
+                       recommendations.c.business_state,
+                       literal(weight, db.Float)])
+            .where(recommendations.c.id == recommendation_id))
+
+        connection.execute(upsert.on_conflict_do_update(
+            index_elements=['recommendation_id'],
+            set_={'score': func.greatest(trending.c.score, upsert.excluded.score)
+                           + func.ln(1 + func.exp(-func.abs(trending.c.score - upsert.excluded.score)))}))
+
+    @classmethod
+    def remove_like(cls, connection, recommendation_id, liked_on, likes_left):
+        """This class method takes a removed like out of the score of a recommendation.
+           The row is deleted when the recommendation has no likes left.
+        """
+
+        trending = cls.__table__
+
+        if not likes_left:
+            connection.execute(trending.delete().where(trending.c.recommendation_id == recommendation_id))
+            return
+
+        weight = cls.like_weight(liked_on)
+
+        # log(e^a - e^b) = a + log(1 - e^(b - a)), floored when the last like is removed.
+        connection.execute(trending.update()
+                           .where(trending.c.recommendation_id == recommendation_id)
+                           .values(score=trending.c.score
+                                   + func.ln(func.greatest(1 - func.exp(func.least(weight - trending.c.score, 0)), 1e-12))))
+
+    @classmethod
+    def top(cls, city, state, limit=TRENDING_TOP_K):
+        """This class method returns the `limit` highest scoring recommendations in a city,
+           with their authors, reading `limit` rows of the (city, state, score) index.
+        """
+
+        return (Recommendation.query
+                .options(db.joinedload('user'))
+                .join(cls, cls.recommendation_id == Recommendation.id)
+                .filter(cls.business_city == city, cls.business_state == state)
+                .order_by(cls.score.desc())
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def reconcile(cls):
+        """This class method rebuilds the scores from the likes of the last TRENDING_WINDOW_DAYS
+           and keeps the TRENDING_KEEP best recommendations of every city. It returns the
+           number of rows kept.
+        """
+
+        likes = Likes.__table__
+        recommendations = Recommendation.__table__
+        trending = cls.__table__
+
+        tau = TRENDING_HALF_LIFE_HOURS * 3600 / math.log(2)
+        since = datetime.datetime.now() - datetime.timedelta(days=TRENDING_WINDOW_DAYS)
+
+        weights = (db.select([likes.c.recommendation_id,
+                              (extract('epoch', likes.c.liked_on - literal(TRENDING_EPOCH, db.DateTime)) / tau).label('weight')])
+                   .where(likes.c.liked_on >= since)
+                   .alias('weights'))
+
+        # log(sum(e^w)) = max(w) + log(sum(e^(w - max(w))))
+        peaks = (db.select([weights.c.recommendation_id, func.max(weights.c.weight).label('peak')])
+                 .group_by(weights.c.recommendation_id)
+                 .alias('peaks'))
+
+        scores = (db.select([recommendations.c.id.label('recommendation_id'),
+                             recommendations.c.business_city,
+                             recommendations.c.business_state,
+                             (peaks.c.peak + func.ln(func.sum(func.exp(weights.c.weight - peaks.c.peak)))).label('score')])
+                  .select_from(weights
+                               .join(peaks, peaks.c.recommendation_id == weights.c.recommendation_id)
+                               .join(recommendations, recommendations.c.id == weights.c.recommendation_id))
+                  .group_by(recommendations.c.id, peaks.c.peak)
+                  .alias('scores'))
+
+        ranked = (db.select([scores,
+                             func.row_number().over(partition_by=[scores.c.business_city, scores.c.business_state],
+                                                    order_by=scores.c.score.desc()).label('position')])
+                  .alias('ranked'))
+
+        db.session.execute(trending.delete())
+        result = db.session.execute(trending.insert().from_select(
+            ['recommendation_id', 'business_city', 'business_state', 'score'],
+            db.select([ranked.c.recommendation_id, ranked.c.business_city, ranked.c.business_state, ranked.c.score])
+            .where(ranked.c.position <= TRENDING_KEEP)))
+
+        return result.rowcount
+
+
+class GeocodeResult(db.Model):
+    """This class holds the structure of the geocode_cache table in the dateMeet db.
+
+       Each row is a Google Geocoding answer for one normalized address. Addresses Google
+       could not resolve are saved too (with `found` set to False) so they are not
+       looked up again until they expire.
+    """
+
+    __tablename__ = "geocode_cache"
+
+    address_key = db.Column(
+                  db.Text,
+                  primary_key=True
+    )
+
+    full_address = db.Column(
+                   db.Text,
+                   nullable=False
+    )
+
+    latitude = db.Column(
+               db.Float,
+               nullable=False
+    )
+
+    longitude = db.Column(
+                db.Float,
+                nullable=False
+    )
+
+    city = db.Column(
+           db.Text,
+           nullable=False
+    )
+
+    state = db.Column(
+            db.Text,
+            nullable=False
+    )
+
+    found = db.Column(
+            db.Boolean,
+            nullable=False,
+            default=True
+    )
+
+    expires_on = db.Column(
+                 db.DateTime,
+                 nullable=False,
+                 index=True
+    )
+
+    def to_location(self):
+        """This method returns the cached row in the same format `helpers.get_lat_lng` returns."""
+
+        p = self
+
+        return {
+            "full_address": p.full_address,
+            "latitude": p.latitude,
+            "longitude": p.longitude,
+            "city": p.city,
+            "state": p.state
+        }
+
+    def __repr__(self):
+        """This method returns a clearer representation of the current geocode instance."""
+
+        p = self
+
+        return f"<address_key = {p.address_key} found = {p.found} expires_on = {p.expires_on}>"
+
+
+####################################################################################
+# Timelines
+#
+# Following a user copies their latest recommendations into the follower's timeline,
+# and unfollowing removes them. Both run in the same transaction as the follow. Follows
+# of authors who are not fanned out are marked pulled instead, when they are made and
+# whenever the author's follower count crosses FANOUT_MAX_FOLLOWERS.
+
+def mark_pulled_follows(connection, author_id, pulled):
+    """This function sets the pulled flag of every follow of `author_id`."""
+
+    follows = Follows.__table__
+
+    connection.execute(follows.update()
+                       .where(follows.c.user_being_followed_id == author_id)
+                       .where(follows.c.pulled != pulled)
+                       .values(pulled=pulled))
+
+
+def backfill_timeline(connection, user_id, author_id):
+    """This function adds the latest TIMELINE_BACKFILL recommendations of `author_id`
+       to the timeline of `user_id`.
+    """
+
+    recommendations = Recommendation.__table__
+    timeline = TimelineEntry.__table__
+
+    latest = (db.select([literal(user_id, db.Integer),
+                         recommendations.c.id,
+                         recommendations.c.user_id,
+                         recommendations.c.created_on])
+              .where(recommendations.c.user_id == author_id)
+              .order_by(recommendations.c.created_on.desc())
+              .limit(TIMELINE_BACKFILL))
+
+    connection.execute(insert(timeline)
+                       .from_select(['user_id', 'recommendation_id', 'author_id', 'created_on'], latest)
+                       .on_conflict_do_nothing())
+
+
+@event.listens_for(Follows, 'before_insert')
+def mark_pulled(mapper, connection, target):
+    users = User.__table__
+
+    followers_count = connection.execute(db.select([users.c.followers_count])
+                                         .where(users.c.id == target.user_being_followed_id)).scalar()
+    target.pulled = followers_count > FANOUT_MAX_FOLLOWERS
+
+
+@event.listens_for(Follows, 'after_insert')
+def add_to_timeline(mapper, connection, target):
+    if not target.pulled:
+        backfill_timeline(connection, target.user_following_id, target.user_being_followed_id)
+
+
+@event.listens_for(Follows, 'after_delete')
+def remove_from_timeline(mapper, connection, target):
+    timeline = TimelineEntry.__table__
+
+    connection.execute(timeline.delete()
+                       .where(timeline.c.user_id == target.user_following_id)
+                       .where(timeline.c.author_id == target.user_being_followed_id))
+
+
+####################################################################################
+# User search
+#
+# The users trigram index serves "contains" searches on username and full name, and
+# the lower(username) index serves prefix (typeahead) searches. Both need postgres.
+
+def escape_like(term):
+    """This function escapes the LIKE wildcards in a search term typed by a user."""
+
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+event.listen(User.__table__, 'before_create',
+             DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect='postgresql'))
+
+event.listen(User.__table__, 'after_create',
+             DDL("CREATE INDEX ix_users_search_trgm ON users "
+                 "USING gin (lower(username || ' ' || first_name || ' ' || last_name) gin_trgm_ops)")
+             .execute_if(dialect='postgresql'))
+
+event.listen(User.__table__, 'after_create',
+             DDL("CREATE INDEX ix_users_username_prefix ON users (lower(username) text_pattern_ops)")
+             .execute_if(dialect='postgresql'))
+
+
+####################################################################################
+# Recommendation search
+#
+# The search_vector of a recommendation is rebuilt in the same INSERT or UPDATE
+# whenever its title, content or business name are set.
+
+SEARCH_DOCUMENT_FIELDS = ('title', 'content', 'business_name')
+
+
+@event.listens_for(Recommendation, 'before_insert')
+def index_recommendation(mapper, connection, target):
+    target.search_vector = Recommendation.search_document(target.title, target.content, target.business_name)
+
+
+@event.listens_for(Recommendation, 'before_update')
+def reindex_recommendation(mapper, connection, target):
+    state = db.inspect(target)
+
+    if any(state.attrs[field].history.has_changes() for field in SEARCH_DOCUMENT_FIELDS):
+        target.search_vector = Recommendation.search_document(target.title, target.content, target.business_name)
+
+
+####################################################################################
+# Card versions
+#
+# Recommendation cards are cached by recommendation and author version, so both are
+# bumped in the same UPDATE that changes what a card shows. Counter updates and
+# location changes don't touch them.
+
+RECOMMENDATION_CARD_FIELDS = ('title', 'content', 'business_name', 'business_address', 'business_city',
+                              'business_state', 'business_rating', 'created_on')
+
+USER_CARD_FIELDS = ('username', 'first_name', 'last_name', 'image_url', 'header_url', 'bio')
+
+
+def bump_version(target, fields):
+    """This function increments the version of `target` if any of `fields` changed."""
+
+    state = db.inspect(target)
+
+    if any(state.attrs[field].history.has_changes() for field in fields):
+        # Incremented in SQL so two concurrent edits can't both write the same version.
+        target.version = type(target).version + 1
+
+
+@event.listens_for(Recommendation, 'before_update')
+def bump_recommendation_version(mapper, connection, target):
+    bump_version(target, RECOMMENDATION_CARD_FIELDS)
+
+
+@event.listens_for(User, 'before_update')
+def bump_user_version(mapper, connection, target):
+    bump_version(target, USER_CARD_FIELDS)
+
+
+####################################################################################
+# User counters
+#
+# Rows added or deleted through the Follows, Likes and Recommendation models update the
+# counters on the users (and recommendations) they belong to, in the same transaction.
+
+def adjust_user_counters(connection, user_id, **deltas):
+    """This function adds `deltas` (e.g. likes_count=1) to the counters of a user and
+       returns the new values of those counters (None if the user is gone).
+    """
+
+    users = User.__table__
+
+    return connection.execute(users.update()
+                              .where(users.c.id == user_id)
+                              .values({users.c[name]: users.c[name] + delta for name, delta in deltas.items()})
+                              .returning(*[users.c[name] for name in deltas])).first()
+
+
+@event.listens_for(Follows, 'after_insert')
+def count_follow(mapper, connection, target):
+    adjust_user_counters(connection, target.user_following_id, following_count=1)
+    followed = adjust_user_counters(connection, target.user_being_followed_id, followers_count=1)
+
+    if followed and followed.followers_count == FANOUT_MAX_FOLLOWERS + 1:
+        mark_pulled_follows(connection, target.user_being_followed_id, True)
+
+
+@event.listens_for(Follows, 'after_delete')
+def uncount_follow(mapper, connection, target):
+    adjust_user_counters(connection, target.user_following_id, following_count=-1)
+    followed = adjust_user_counters(connection, target.user_being_followed_id, followers_count=-1)
+
+    if followed and followed.followers_count == FANOUT_MAX_FOLLOWERS:
+        mark_pulled_follows(connection, target.user_being_followed_id, False)
+
+
+def adjust_recommendation_likes(connection, recommendation_id, delta):
+    """This function adds `delta` to the likes_count of a recommendation and returns the
+       new count (None if the recommendation is gone).
+    """
+
+    recommendations = Recommendation.__table__
+
+    return connection.execute(recommendations.update()
+                              .where(recommendations.c.id == recommendation_id)
+                              .values(likes_count=recommendations.c.likes_count + delta)
+                              .returning(recommendations.c.likes_count)).scalar()
+
+
+def like_added(connection, user_id, recommendation_id, liked_on):
+    """This function updates the like counters and the trending scores for a new like."""
+
+    adjust_user_counters(connection, user_id, likes_count=1)
+    adjust_recommendation_likes(connection, recommendation_id, 1)
+    TrendingRecommendation.add_like(connection, recommendation_id, liked_on)
+
+
+def like_removed(connection, user_id, recommendation_id, liked_on):
+    """This function updates the like counters and the trending scores for a removed like."""
+
+    adjust_user_counters(connection, user_id, likes_count=-1)
+    likes_left = adjust_recommendation_likes(connection, recommendation_id, -1)
+    TrendingRecommendation.remove_like(connection, recommendation_id, liked_on, likes_left)
+
+
+def like_time(connection, target):
+    """This function returns when a like was made, reading the row if the instance
+       does not have it loaded (loading it during a flush is not allowed).
+    """
+
+    liked_on = db.inspect(target).dict.get('liked_on')
+
+    if liked_on is None:
+        likes = Likes.__table__
+        liked_on = connection.execute(db.select([likes.c.liked_on]).where(likes.c.id == target.id)).scalar()
+
+    return liked_on
+
+
+@event.listens_for(Likes, 'after_insert')
+def count_like(mapper, connection, target):
+    like_added(connection, target.user_id, target.recommendation_id, like_time(connection, target))
+
+
+@event.listens_for(Likes, 'before_delete')
+def uncount_like(mapper, connection, target):
+    like_removed(connection, target.user_id, target.recommendation_id, like_time(connection, target))
+
+
+@event.listens_for(Recommendation, 'after_insert')
+def count_recommendation(mapper, connection, target):
+    adjust_user_counters(connection, target.user_id, recommendation_count=1)
+
+
+@event.listens_for(Recommendation, 'before_delete')
+def uncount_recommendation(mapper, connection, target):
+    # The likes of this recommendation are removed by the db cascade, 
+    # so the users who liked it are counted down first.
+
+    users = User.__table__
+    likes = Likes.__table__
+
+    connection.execute(users.update()
+                       .where(users.c.id.in_(db.select([likes.c.user_id])
+                                             .where(likes.c.recommendation_id == target.id)))
+                       .values(likes_count=users.c.likes_count - 1))
+
+    adjust_user_counters(connection, target.user_id, recommendation_count=-1)
+
 
 def connect_db(app):
     """This method connects this database to provided Flask app
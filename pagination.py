@@ -0,0 +1,146 @@
+"""This file holds the keyset (cursor) pagination helpers used by the dateMeet app.
+
+Instead of OFFSET, every page after the first is fetched with a WHERE clause on the
+sort key of the last row already shown, e.g. (created_on, id) < (:created_on, :id).
+With an index on the sort key every page costs the same, no matter how deep it is.
+"""
+
+import base64
+import datetime
+import decimal
+import heapq
+import json
+from collections import namedtuple
+
+from sqlalchemy import DateTime, tuple_
+
+Page = namedtuple("Page", ["items", "next_cursor"])
+
+
+class InvalidCursor(ValueError):
+    """This exception is raised when a cursor sent by a client cannot be decoded."""
+
+
+def encode_cursor(values, scope=None):
+    """This function encodes the sort key values of a row as an opaque, url safe cursor.
+
+       `scope` (e.g. the name of the sort order) is saved in the cursor, and
+       `decode_cursor` rejects the cursor when it is given another scope.
+    """
+
+    values = [value.isoformat() if isinstance(value, datetime.datetime) else value for value in values]
+
+    if scope is not None:
+        values = [scope] + values
+
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def cursor_value(column, value):
+    """This function returns `value`, read from a cursor, as a value of `column`'s type.
+
+       Values of the wrong type raise TypeError here, so a tampered cursor is rejected
+       before it reaches the database as a query that can't run.
+    """
+
+    if isinstance(column.type, DateTime):
+        return datetime.datetime.fromisoformat(value)
+
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+
+    if isinstance(value, bool):
+        raise TypeError(value)
+
+    if python_type is int and isinstance(value, int):
+        return value
+
+    if python_type in (float, decimal.Decimal) and isinstance(value, (int, float)):
+        return value
+
+    if python_type is str and isinstance(value, str):
+        return value
+
+    raise TypeError(value)
+
+
+def decode_cursor(cursor, columns, scope=None):
+    """This function decodes a cursor made by `encode_cursor` back into values for `columns`."""
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw.decode("utf-8"))
+
+        if scope is not None:
+            if not isinstance(values, list) or not values or values[0] != scope:
+                raise InvalidCursor(cursor)
+
+            values = values[1:]
+
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise InvalidCursor(cursor)
+
+        return [cursor_value(column, value) for column, value in zip(columns, values)]
+
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(cursor) from e
+
+
+def keyset_page(query, columns, cursor=None, per_page=50, key=None, scope=None):
+    """This function returns one page of `query`, sorted by `columns` in descending order.
+
+       `cursor` is the `next_cursor` of the previous page (None for the first page).
+       `key` turns a row into the values of `columns`; by default each column name is
+       read from the row. The last column should be unique (usually the primary key)
+       so rows with equal sort values are neither skipped nor repeated. When one query
+       can be paged in several orders, `scope` names the order, so a cursor from one
+       order raises InvalidCursor in another.
+    """
+
+    if key is None:
+        key = lambda row: [getattr(row, column.key) for column in columns]
+
+    if cursor:
+        values = decode_cursor(cursor, columns, scope)
+        query = query.filter(tuple_(*columns) < tuple_(*values))
+
+    rows = query.order_by(*[column.desc() for column in columns]).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(key(rows[-1]), scope)
+
+    return Page(rows, next_cursor)
+
+
+def merge_pages(pages, per_page, key):
+    """This function merges pages fetched with the same cursor from different sources into
+       one page, newest (largest `key`) first, dropping rows that appear in several pages.
+
+       `key` returns the sort key values of a row, as for `keyset_page`.
+    """
+
+    items = []
+    seen = set()
+    more = any(page.next_cursor for page in pages)
+
+    for row in heapq.merge(*[page.items for page in pages], key=key, reverse=True):
+        if tuple(key(row)) in seen:
+            continue
+
+        if len(items) == per_page:
+            more = True
+            break
+
+        seen.add(tuple(key(row)))
+        items.append(row)
+
+    next_cursor = encode_cursor(key(items[-1])) if more and items else None
+
+    return Page(items, next_cursor)
+
@@ -0,0 +1,68 @@
+"""This file holds the password hashing helpers used by the dateMeet app.
+
+bcrypt is slow on purpose. Hashes and checks run inline on the request's own thread
+(bcrypt releases the GIL while it works), but at most BCRYPT_MAX_THREADS of them at once
+per worker, so a burst of logins can't take every core. The work factor comes from
+BCRYPT_LOG_ROUNDS; hashes made with another work factor are upgraded when their owner
+logs in (see `needs_rehash`).
+"""
+
+import os
+import threading
+
+from flask import current_app
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+_slots_size = os.cpu_count() or 2
+_slots = threading.BoundedSemaphore(_slots_size)
+
+
+def init_passwords(app):
+    """This function configures the work factor and how many hashes may run at once from
+       the app config.
+    """
+
+    global _slots, _slots_size
+
+    app.config.setdefault('BCRYPT_LOG_ROUNDS', int(os.environ.get('BCRYPT_LOG_ROUNDS', 12)))
+    app.config.setdefault('BCRYPT_MAX_THREADS', int(os.environ.get('BCRYPT_MAX_THREADS', _slots_size)))
+
+    bcrypt.init_app(app)
+
+    if app.config['BCRYPT_MAX_THREADS'] != _slots_size:
+        _slots_size = app.config['BCRYPT_MAX_THREADS']
+        _slots = threading.BoundedSemaphore(_slots_size)
+
+
+def hash_password(password):
+    """This function returns the bcrypt hash (as text) of `password` with the current work factor.
+
+       Like Flask-Bcrypt it raises a ValueError for an empty password.
+    """
+
+    with _slots:
+        return bcrypt.generate_password_hash(password, current_app.config['BCRYPT_LOG_ROUNDS']).decode('UTF-8')
+
+
+def check_password(password_hash, password):
+    """This function checks `password` against a bcrypt hash made by `hash_password`."""
+
+    with _slots:
+        return bcrypt.check_password_hash(password_hash, password)
+
+
+def hash_rounds(password_hash):
+    """This function returns the work factor a bcrypt hash ("$2b$12$...") was made with."""
+
+    try:
+        return int(password_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def needs_rehash(password_hash):
+    """This function checks if a hash was made with a work factor other than the current one."""
+
+    return hash_rounds(password_hash) != current_app.config['BCRYPT_LOG_ROUNDS']
@@ -0,0 +1,135 @@
+"""This file holds the SQL query recorder for the dateMeet app.
+
+Every statement sent to the database is timed through SQLAlchemy engine events. Per
+request, the number of statements and the total time spent in the database are logged
+with the endpoint name and sent back in a `Server-Timing` header. Tests can use
+`QueryBudgetMixin.assertMaxQueries` to make sure a route stays within a query budget.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class QueryStats:
+    """This class holds the statements counted while it is active."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = []
+
+    def record(self, statement, duration):
+        """This method counts one statement that took `duration` seconds."""
+
+        self.count += 1
+        self.duration += duration
+        self.statements.append(statement)
+
+
+def _active_stats():
+    """This function returns the list of QueryStats currently recording on this thread."""
+
+    if not hasattr(_local, "active"):
+        _local.active = []
+
+    return _local.active
+
+
+@contextmanager
+def record_queries():
+    """This context manager yields a QueryStats object that counts every statement
+       executed on this thread until the block exits.
+    """
+
+    stats = QueryStats()
+    _active_stats().append(stats)
+
+    try:
+        yield stats
+    finally:
+        _active_stats().remove(stats)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """This function saves the time a statement was sent to the database."""
+
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """This function adds the statement that just finished to every active QueryStats."""
+
+    duration = time.perf_counter() - conn.info["query_start_time"].pop()
+
+    for stats in _active_stats():
+        stats.record(statement, duration)
+
+
+def init_query_recorder(app):
+    """This function wires the query recorder into the Flask app.
+
+       It should be called before the app's own before_request hooks are
+       registered, so the queries they run are counted too.
+    """
+
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+    warn_count = app.config.setdefault("SQL_QUERY_WARN_COUNT", 20)
+
+    @app.before_request
+    def start_query_stats():
+        """Start counting the queries of this request."""
+
+        g.query_stats = QueryStats()
+        _active_stats().append(g.query_stats)
+
+    @app.after_request
+    def report_query_stats(response):
+        """Log the queries of this request and add them to the Server-Timing header."""
+
+        stats = g.get("query_stats")
+        if stats is None:
+            return response
+
+        duration_ms = stats.duration * 1000
+        response.headers.add("Server-Timing", f'db;dur={duration_ms:.1f};desc="{stats.count} queries"')
+
+        log = app.logger.warning if stats.count > warn_count else app.logger.debug
+        log("%s %s (%s): %d queries in %.1f ms", request.method, request.path,
+            request.endpoint, stats.count, duration_ms)
+
+        return response
+
+    @app.teardown_request
+    def stop_query_stats(exc):
+        """Stop counting queries once the request is over."""
+
+        stats = g.get("query_stats")
+        if stats in _active_stats():
+            _active_stats().remove(stats)
+
+
+class QueryBudgetMixin:
+    """This mixin adds a query budget assertion to unittest test cases."""
+
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        """This context manager fails the test when more than `budget` statements
+           are executed inside its block.
+        """
+
+        with record_queries() as stats:
+            yield stats
+
+        if stats.count > budget:
+            statements = "\n".join(stats.statements)
+            self.fail(f"{stats.count} queries executed, budget was {budget}:\n{statements}")
@@ -0,0 +1,325 @@
+"""Helper and cache tests for the dateMeet app."""
+
+# run these tests like:
+#
+#    python -m unittest test_helpers.py
+
+
+import os
+from unittest import TestCase, mock
+
+import requests
+
+from models import db, GeocodeResult
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///dateMeet_test"
+
+
+# Now we can import app
+
+from app import create_app
+import helpers
+from cache import LRUCache, StaleWhileRevalidateCache, normalize_address
+from http_client import ProviderClient, ProviderUnavailable
+
+app = create_app('test')
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+GOOGLE_PAYLOAD = {
+    "status": "OK",
+    "results": [{
+        "formatted_address": "10220 104 Ave NW, Edmonton, AB T5J 0H6, Canada",
+        "geometry": {"location": {"lat": 53.5461, "lng": -113.4938}},
+        "address_components": [
+            {"short_name": "10220"},
+            {"short_name": "104 Ave NW"},
+            {"short_name": "Downtown"},
+            {"short_name": "Edmonton"},
+            {"short_name": "AB"},
+            {"short_name": "CA"},
+            {"short_name": "T5J 0H6"}
+        ]
+    }]
+}
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the in-process LRU cache."""
+
+    def test_normalize_address(self):
+        """Do trivially different spellings of an address share one key?"""
+
+        self.assertEqual(normalize_address("  10220 104 Ave NW ,Edmonton  AB "),
+                         normalize_address("10220 104 ave nw, edmonton ab"))
+
+    def test_lru_eviction(self):
+        """Is the least recently used entry evicted when the cache is full?"""
+
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_lru_expiry(self):
+        """Are expired entries dropped and counted?"""
+
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set("a", 1, ttl=-1)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["expired"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+
+class StaleWhileRevalidateCacheTestCase(TestCase):
+    """Test the stale-while-revalidate cache used for Yelp searches."""
+
+    def test_fresh_entry_served(self):
+        """Is a fresh entry served without calling the loader again?"""
+
+        cache = StaleWhileRevalidateCache(max_size=10, fresh_ttl=60, stale_ttl=60)
+        loader = mock.Mock(return_value="businesses")
+
+        self.assertEqual(cache.get_or_load("coffee", loader), "businesses")
+        self.assertEqual(cache.get_or_load("coffee", loader), "businesses")
+        self.assertEqual(loader.call_count, 1)
+        self.assertEqual(cache.stats()["fresh_hits"], 1)
+
+    def test_stale_entry_served_and_refreshed(self):
+        """Is a stale entry served immediately and then refreshed in the background?"""
+
+        cache = StaleWhileRevalidateCache(max_size=10, fresh_ttl=0, stale_ttl=60)
+        cache.get_or_load("coffee", lambda: "old")
+
+        with mock.patch("threading.Thread") as thread:
+            self.assertEqual(cache.get_or_load("coffee", lambda: "new"), "old")
+            target = thread.call_args[1]["target"]
+            target(*thread.call_args[1]["args"])
+
+        self.assertEqual(cache.stats()["stale_hits"], 1)
+        self.assertEqual(cache.stats()["refreshes"], 1)
+        self.assertEqual(cache._entries.get("coffee")[0], "new")
+
+    def test_yelp_search_cache_key(self):
+        """Do searches that only differ in case and spacing share one Yelp request?"""
+
+        helpers.yelp_search_cache.clear()
+
+        with mock.patch("helpers.yelp_business_search", return_value={"businesses": []}) as search:
+            helpers.cached_yelp_business_search("key", "10220 104 Ave NW, Edmonton", "Coffee ")
+            helpers.cached_yelp_business_search("key", "10220 104 ave nw,edmonton", "coffee")
+
+        self.assertEqual(search.call_count, 1)
+
+
+class YelpFanoutTestCase(TestCase):
+    """Test the concurrent multi-interest Yelp search."""
+
+    def fake_search(self, apikey, address, term, offset=50):
+        """Return one business per search and one business every search finds."""
+
+        if term == "closed":
+            raise ProviderUnavailable("yelp circuit is open")
+
+        return {"businesses": [{"yelp_id": f"{term}-{offset}", "name": term},
+                               {"yelp_id": "everywhere", "name": "Everywhere"}]}
+
+    def test_fanout_merges_results(self):
+        """Are the results of every interest and page merged on yelp_id?"""
+
+        with mock.patch("helpers.cached_yelp_business_search", side_effect=self.fake_search) as search:
+            result = helpers.yelp_multi_business_search("key", "Edmonton", ["Dinner", "drinks", "dinner "], pages=2)
+
+        self.assertEqual(search.call_count, 4)
+        self.assertEqual(result["interests"], ["dinner", "drinks"])
+
+        ids = [biz["yelp_id"] for biz in result["businesses"]]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertIn("drinks-50", ids)
+
+        everywhere = [biz for biz in result["businesses"] if biz["yelp_id"] == "everywhere"][0]
+        self.assertEqual(everywhere["interests"], ["dinner", "drinks"])
+
+    def test_fanout_partial_failure(self):
+        """Are the interests that failed reported next to the ones that worked?"""
+
+        with mock.patch("helpers.cached_yelp_business_search", side_effect=self.fake_search):
+            result = helpers.yelp_multi_business_search("key", "Edmonton", ["dessert", "closed"])
+
+            self.assertEqual(result["failed"], ["closed"])
+
+            with self.assertRaises(ProviderUnavailable):
+                helpers.yelp_multi_business_search("key", "Edmonton", ["closed"])
+
+    def test_fanout_failed_pages(self):
+        """Are the pages that worked returned when one page of every interest failed?"""
+
+        def flaky_search(apikey, address, term, offset=0):
+            if offset:
+                raise ProviderUnavailable("yelp request failed")
+            return self.fake_search(apikey, address, term, offset)
+
+        with mock.patch("helpers.cached_yelp_business_search", side_effect=flaky_search):
+            result = helpers.yelp_multi_business_search("key", "Edmonton", ["dinner", "drinks"], pages=2)
+
+        self.assertEqual(result["failed"], ["dinner", "drinks"])
+        self.assertIn("dinner-0", [biz["yelp_id"] for biz in result["businesses"]])
+
+
+class ProviderClientTestCase(TestCase):
+    """Test the pooled outbound HTTP client."""
+
+    def setUp(self):
+        """Create a client that does not sleep between retries."""
+
+        self.client = ProviderClient("test", max_retries=2, backoff=0, failure_threshold=2, reset_timeout=60)
+
+    def test_retry_then_success(self):
+        """Is a timed out request retried?"""
+
+        ok = mock.Mock(status_code=200)
+
+        with mock.patch.object(self.client.session, "get", side_effect=[requests.Timeout(), ok]) as get:
+            self.assertIs(self.client.get("https://example.com"), ok)
+
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(self.client.breaker.state, "closed")
+
+    def test_circuit_opens(self):
+        """Does the client fail fast once the provider keeps failing?"""
+
+        with mock.patch.object(self.client.session, "get", side_effect=requests.ConnectionError()) as get:
+            for i in range(2):
+                with self.assertRaises(ProviderUnavailable):
+                    self.client.get("https://example.com")
+
+            self.assertEqual(get.call_count, 6)
+            self.assertEqual(self.client.breaker.state, "open")
+
+            with self.assertRaises(ProviderUnavailable):
+                self.client.get("https://example.com")
+
+            self.assertEqual(get.call_count, 6)
+
+    def test_half_open_trial_always_recorded(self):
+        """Does a trial call that fails in an unexpected way leave the circuit usable?"""
+
+        self.client.breaker.state = "open"
+        self.client.breaker.opened_at = 0
+
+        with mock.patch.object(self.client.session, "get", side_effect=requests.TooManyRedirects()) as get:
+            with self.assertRaises(ProviderUnavailable):
+                self.client.get("https://example.com")
+
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(self.client.breaker.state, "open")
+
+        self.client.breaker.opened_at = 0
+        ok = mock.Mock(status_code=200)
+
+        with mock.patch.object(self.client.session, "get", return_value=ok):
+            self.assertIs(self.client.get("https://example.com"), ok)
+
+        self.assertEqual(self.client.breaker.state, "closed")
+
+    def test_per_host_breakers(self):
+        """Does a host that keeps failing leave the circuits of other hosts closed?"""
+
+        client = ProviderClient("test", max_retries=0, backoff=0, failure_threshold=2, per_host_breakers=True)
+        ok = mock.Mock(status_code=200)
+
+        def fake_get(url, **kwargs):
+            if "broken" in url:
+                raise requests.ConnectionError()
+            return ok
+
+        with mock.patch.object(client.session, "get", side_effect=fake_get):
+            for i in range(2):
+                with self.assertRaises(ProviderUnavailable):
+                    client.get("https://broken.example.com/a.png")
+
+            self.assertIs(client.get("https://example.com/a.png"), ok)
+
+        self.assertEqual(client.stats()["open_circuits"], ["broken.example.com"])
+
+
+class GeocodeCacheTestCase(TestCase):
+    """Test the geocode cache in front of the Google Geocoding API."""
+
+    def setUp(self):
+        """Start every test with empty caches."""
+        db.drop_all()
+        db.create_all()
+
+        helpers.geocode_cache.clear()
+
+    def tearDown(self):
+        """Clean up any fouled transactions."""
+
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def test_cached_geocode(self):
+        """Is a normalized address only sent to Google once?"""
+
+        with mock.patch("helpers.request_geocode", return_value=GOOGLE_PAYLOAD) as request_geocode:
+            first = helpers.cached_get_lat_lng("key", "10220 104 Ave NW, Edmonton")
+            second = helpers.cached_get_lat_lng("key", "10220 104 ave nw ,  edmonton")
+
+        self.assertEqual(request_geocode.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(first["city"], "Edmonton")
+        self.assertIsNotNone(GeocodeResult.query.get("10220 104 ave nw, edmonton"))
+
+    def test_cached_geocode_from_db(self):
+        """Is a result saved by another worker read back from the geocode_cache table?"""
+
+        with mock.patch("helpers.request_geocode", return_value=GOOGLE_PAYLOAD):
+            helpers.cached_get_lat_lng("key", "10220 104 Ave NW, Edmonton")
+
+        helpers.geocode_cache.clear()
+
+        with mock.patch("helpers.request_geocode") as request_geocode:
+            location = helpers.cached_get_lat_lng("key", "10220 104 Ave NW, Edmonton")
+
+        request_geocode.assert_not_called()
+        self.assertEqual(location["state"], "AB")
+
+    def test_negative_geocode_cached(self):
+        """Is an address Google cannot resolve cached as not found?"""
+
+        with mock.patch("helpers.request_geocode", return_value={"status": "ZERO_RESULTS", "results": []}) as request_geocode:
+            first = helpers.cached_get_lat_lng("key", "nowhere at all")
+            second = helpers.cached_get_lat_lng("key", "nowhere at all")
+
+        self.assertEqual(request_geocode.call_count, 1)
+        self.assertEqual(first["latitude"], 0)
+        self.assertEqual(second["longitude"], 0)
+        self.assertFalse(GeocodeResult.query.get("nowhere at all").found)
+
+    def test_failed_geocode_not_cached(self):
+        """Are network errors left out of the cache?"""
+
+        with mock.patch("helpers.request_geocode", side_effect=IOError) as request_geocode:
+            helpers.cached_get_lat_lng("key", "10220 104 Ave NW, Edmonton")
+            helpers.cached_get_lat_lng("key", "10220 104 Ave NW, Edmonton")
+
+        self.assertEqual(request_geocode.call_count, 2)
+        self.assertIsNone(GeocodeResult.query.get("10220 104 ave nw, edmonton"))
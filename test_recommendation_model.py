@@ -5,11 +5,12 @@
 #    python -m unittest test_recommendation_model.py
 
 
+import datetime
 import os
 from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, User, Recommendation, Follows, Location, Likes
+from models import db, User, Recommendation, Follows, Location, Likes, TrendingRecommendation
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,7 +22,9 @@ os.environ['DATABASE_URL'] = "postgresql:///dateMeet_test"
 
 # Now we can import app
 
-from app import app
+from app import create_app
+
+app = create_app('test')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -107,7 +110,7 @@ class   RecommendationModelTestCase(TestCase):
         db.session.add(r1)
         db.session.commit()
 
-        u.likes.append(r1)
+        Likes.toggle(uid2, r1.id)
 
         db.session.commit()
 
@@ -116,4 +119,156 @@ class   RecommendationModelTestCase(TestCase):
         # There should be only one liked message and it should be m1
 
         self.assertEqual(len(l), 1)
-        self.assertEqual(l[0].recommendation_id, r1.id)
\ No newline at end of file
+        self.assertEqual(l[0].recommendation_id, r1.id)
+
+    def test_recommendations_within_radius(self):
+        """This test method tests that the radius query only returns recommendations
+           close enough to the point, closest first.
+        """
+
+        downtown = Recommendation(
+            title="Coffee downtown",
+            content="Great espresso on Jasper Ave",
+            business_name="Credo",
+            business_address="10134 104 St NW",
+            business_city="Edmonton",
+            business_state="Alberta",
+            business_country="Canada",
+            business_rating=5,
+            user_id=self.uid
+        )
+        downtown.set_coordinates(53.5437, -113.4966)
+
+        sherwood_park = Recommendation(
+            title="Coffee in Sherwood Park",
+            content="Just outside the city",
+            business_name="Remedy",
+            business_address="2020 Sherwood Dr",
+            business_city="Sherwood Park",
+            business_state="Alberta",
+            business_country="Canada",
+            business_rating=4,
+            user_id=self.uid
+        )
+        sherwood_park.set_coordinates(53.5412, -113.2957)
+
+        calgary = Recommendation(
+            title="Coffee in Calgary",
+            content="Too far for a date",
+            business_name="Monogram",
+            business_address="4814 16 St SW",
+            business_city="Calgary",
+            business_state="Alberta",
+            business_country="Canada",
+            business_rating=4,
+            user_id=self.uid
+        )
+        calgary.set_coordinates(51.0447, -114.0719)
+
+        db.session.add_all([downtown, sherwood_park, calgary])
+        db.session.commit()
+
+        nearby = Recommendation.within_radius(53.5461, -113.4938, 25)
+
+        self.assertEqual([r.title for r, distance in nearby], ["Coffee downtown", "Coffee in Sherwood Park"])
+        self.assertLess(nearby[0][1], 1)
+
+    def test_recommendation_search(self):
+        """This test method tests that recommendation search matches titles, content 
+           and business names, ranks title matches first and applies the filters.
+        """
+
+        sushi = Recommendation(
+            title="Best sushi in town",
+            content="Fresh nigiri and a quiet room",
+            business_name="Kyoto",
+            business_address="10220 103 St NW",
+            business_city="Edmonton",
+            business_state="Alberta",
+            business_country="Canada",
+            business_rating=5,
+            user_id=self.uid
+        )
+
+        ramen = Recommendation(
+            title="Late night ramen",
+            content="They also have a small sushi menu",
+            business_name="Prairie Noodle",
+            business_address="10350 124 St NW",
+            business_city="Edmonton",
+            business_state="Alberta",
+            business_country="Canada",
+            business_rating=3,
+            user_id=self.uid
+        )
+
+        burger = Recommendation(
+            title="Burgers",
+            content="Nothing fishy here",
+            business_name="Sushi Burger Bar",
+            business_address="4814 16 St SW",
+            business_city="Calgary",
+            business_state="Alberta",
+            business_country="Canada",
+            business_rating=4,
+            user_id=self.uid
+        )
+
+        db.session.add_all([sushi, ramen, burger])
+        db.session.commit()
+
+        page = Recommendation.search("sushi")
+        self.assertEqual(set(page.items), {sushi, ramen, burger})
+        self.assertEqual(page.items[-1], ramen)
+
+        page = Recommendation.search("sushi", city="edmonton", min_rating=4)
+        self.assertEqual(page.items, [sushi])
+
+        # Edited recommendations are reindexed
+        ramen.content = "Just noodles"
+        db.session.commit()
+        self.assertNotIn(ramen, Recommendation.search("sushi").items)
+
+    def test_trending_recommendations(self):
+        """This test method tests that trending recommendations are ranked by
+           likes that decay with time, both incrementally and after a reconcile.
+        """
+
+        liker1 = User.register("Liker", "One", "liker1@test.com", "liker1", "passWord4u", None, None)
+        liker2 = User.register("Liker", "Two", "liker2@test.com", "liker2", "passWord4u", None, None)
+
+        older = Recommendation(title="Old favourite", content="Liked last week", business_name="Credo",
+                               business_address="10134 104 St NW", business_city="Edmonton",
+                               business_state="Alberta", business_country="Canada",
+                               business_rating=5, user_id=self.uid)
+        newer = Recommendation(title="New spot", content="Liked today", business_name="Remedy",
+                               business_address="10279 Jasper Ave", business_city="Edmonton",
+                               business_state="Alberta", business_country="Canada",
+                               business_rating=4, user_id=self.uid)
+        db.session.add_all([older, newer])
+        db.session.commit()
+
+        three_days_ago = datetime.datetime.now() - datetime.timedelta(days=3)
+        db.session.add_all([Likes(user_id=liker1.id, recommendation_id=older.id, liked_on=three_days_ago),
+                            Likes(user_id=liker2.id, recommendation_id=older.id, liked_on=three_days_ago)])
+        db.session.commit()
+
+        self.assertTrue(Likes.toggle(liker1.id, newer.id))
+        db.session.commit()
+
+        # One like today outweighs two likes from three days ago
+        self.assertEqual(TrendingRecommendation.top("Edmonton", "Alberta"), [newer, older])
+
+        TrendingRecommendation.reconcile()
+        db.session.commit()
+        self.assertEqual(TrendingRecommendation.top("Edmonton", "Alberta"), [newer, older])
+
+        self.assertFalse(Likes.toggle(liker1.id, newer.id))
+        db.session.commit()
+        self.assertEqual(TrendingRecommendation.top("Edmonton", "Alberta", limit=1), [older])
+        self.assertEqual(TrendingRecommendation.top("Calgary", "Alberta"), [])
+
+        # Removing the last like of a recommendation takes it out of trending altogether
+        self.assertEqual(TrendingRecommendation.top("Edmonton", "Alberta"), [older])
+        self.assertIsNone(TrendingRecommendation.query.get(newer.id))
+
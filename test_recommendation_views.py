@@ -7,10 +7,11 @@ FLASK_ENV=production python -m unittest test_recommendation_views.py
 """
 
 
+import gzip
 import os
-from unittest import TestCase
+from unittest import TestCase, mock
 
-from models import db, connect_db, Recommendation, Location, User
+from models import db, connect_db, Recommendation, Location, User, Follows, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -22,7 +23,11 @@ os.environ['DATABASE_URL'] = "postgresql:///dateMeet_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY, CURR_LOCATION
+from app import create_app, CURR_USER_KEY, CURR_LOCATION
+from pagination import encode_cursor
+from query_stats import QueryBudgetMixin
+
+app = create_app('test')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -35,13 +40,15 @@ db.create_all()
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class RecommendationViewTestCase(TestCase):
+class RecommendationViewTestCase(QueryBudgetMixin, TestCase):
     """Test views for recommendations."""
 
     def setUp(self):
         """Create test client, add sample data."""
         db.drop_all()
         db.create_all()
+        # Ids and versions start over with every test, so cached cards would be stale.
+        app.jinja_env.fragment_cache.clear()
 
         self.client = app.test_client()
 
@@ -263,5 +270,340 @@ class RecommendationViewTestCase(TestCase):
             r = Recommendation.query.get(419)
             self.assertIsNotNone(r)
 
-    
-   
\ No newline at end of file
+
+    def test_recommendations_feed_pages(self):
+        """This test method confirms that the JSON recommendations feed is paginated
+           by cursor, newest first, without repeating or skipping recommendations.
+        """
+
+        L = Location(
+            name="Home",
+            address="False Test Creek SW, Long Beach CA",
+            long=143.12,
+            lat=-234.5,
+            city="Long Beach",
+            state="CA",
+            user_id=self.testuser_id
+        )
+        L.id = 124
+
+        db.session.add(L)
+
+        for i in range(5):
+            db.session.add(Recommendation(
+                title=f"Doughnut spot {i}",
+                content="Leonards bro!",
+                business_name="Leonards",
+                business_address="2345 Rodeo Ave",
+                business_city="Long Beach",
+                business_state="CA",
+                business_country="US",
+                business_rating=5,
+                user_id=self.u2id
+            ))
+
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+                sess[CURR_LOCATION] = 124
+
+            with mock.patch("app.FEED_PAGE_SIZE", 2):
+                titles = []
+                cursor = None
+
+                for page in range(3):
+                    resp = c.get("/dateMeet/api/recommendations", query_string={"before": cursor} if cursor else {})
+                    self.assertEqual(resp.status_code, 200)
+
+                    titles += [r["title"] for r in resp.json["recommendations"]]
+                    cursor = resp.json["next_cursor"]
+
+            self.assertIsNone(cursor)
+            self.assertEqual(titles, [f"Doughnut spot {i}" for i in reversed(range(5))])
+
+            resp = c.get("/dateMeet/api/recommendations?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+            # A well formed cursor with values of the wrong type is rejected too.
+            resp = c.get("/dateMeet/api/recommendations", query_string={"before": encode_cursor(["yesterday", "1"], "newest")})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_list_recommendations_query_budget(self):
+        """This test method confirms that the recommendations feed runs a fixed
+           number of queries, no matter how many recommendations are rendered.
+        """
+
+        L = Location(
+            name="Home",
+            address="False Test Creek SW, Long Beach CA",
+            long=143.12,
+            lat=-234.5,
+            city="Long Beach",
+            state="CA",
+            user_id=self.testuser_id
+        )
+        L.id = 124
+
+        db.session.add(L)
+
+        for i in range(10):
+            db.session.add(Recommendation(
+                title=f"Doughnut spot {i}",
+                content="Leonards bro!",
+                business_name="Leonards",
+                business_address="2345 Rodeo Ave",
+                business_city="Long Beach",
+                business_state="CA",
+                business_country="US",
+                business_rating=5,
+                user_id=self.u2id if i % 2 else self.testuser_id
+            ))
+
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+                sess[CURR_LOCATION] = 124
+
+            with self.assertMaxQueries(6):
+                resp = c.get("/recommendations/list")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Doughnut spot 9", str(resp.data))
+
+    def test_nearby_recommendations_query_budget(self):
+        """This test method confirms that the nearby recommendations page runs a fixed
+           number of queries, no matter how many recommendations are rendered.
+        """
+
+        L = Location(
+            name="Home",
+            address="10220 104 Ave NW, Edmonton AB",
+            long=-113.4938,
+            lat=53.5461,
+            city="Edmonton",
+            state="AB",
+            user_id=self.testuser_id
+        )
+        L.id = 124
+
+        db.session.add(L)
+
+        for i in range(10):
+            recommendation = Recommendation(
+                title=f"Coffee spot {i}",
+                content="Great flat whites",
+                business_name="Remedy",
+                business_address="10310 102 Ave NW",
+                business_city="Edmonton",
+                business_state="AB",
+                business_country="CA",
+                business_rating=4,
+                user_id=self.u2id if i % 2 else self.testuser_id
+            )
+            recommendation.set_coordinates(53.5461 + i / 1000, -113.4938)
+            db.session.add(recommendation)
+
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+                sess[CURR_LOCATION] = 124
+
+            with self.assertMaxQueries(6):
+                resp = c.get("/recommendations/nearby")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Coffee spot 9", str(resp.data))
+
+    def test_timeline(self):
+        """This test method confirms that new recommendations reach the timelines
+           of the author's followers, both when fanned out on write and when 
+           merged in on read for authors with many followers.
+        """
+
+        db.session.add(Follows(user_following_id=self.u2id, user_being_followed_id=self.testuser_id))
+        db.session.commit()
+
+        data = {"content": "Worth the trip", "business_name": "Nana Buns",
+                "business_address": "2568 Nappy Ave DMV", "business_city": "Houston",
+                "business_state": "Texas", "business_country": "USA", "business_rating": 4}
+
+        with self.client as c, mock.patch("app.locate_recommendation", return_value=False):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/recommendations/new", data=dict(data, title="Fanned out on write"))
+            self.assertEqual(TimelineEntry.query.filter_by(user_id=self.u2id).count(), 1)
+
+            with mock.patch("models.FANOUT_MAX_FOLLOWERS", 0):
+                c.post("/recommendations/new", data=dict(data, title="Merged in on read"))
+                self.assertEqual(TimelineEntry.query.filter_by(user_id=self.u2id).count(), 1)
+
+                # The limit moved under the existing follow, so recount to mark it pulled
+                User.reconcile_counters()
+                db.session.commit()
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2id
+
+                resp = c.get("/dateMeet/api/timeline")
+
+            titles = [recommendation["title"] for recommendation in resp.json["recommendations"]]
+            self.assertEqual(titles, ["Merged in on read", "Fanned out on write"])
+
+            # Unfollowing removes the author from the timeline
+            c.post(f"/users/unfollow/{self.testuser_id}")
+            self.assertEqual(TimelineEntry.query.filter_by(user_id=self.u2id).count(), 0)
+
+    def test_recommendations_feed_sorted_by_likes(self):
+        """This test method confirms that likes are counted on recommendations
+           and that the feed can be sorted by them.
+        """
+
+        L = Location(name="Home", address="False Test Creek SW, Long Beach CA", long=143.12, lat=-234.5,
+                     city="Long Beach", state="CA", user_id=self.testuser_id)
+        L.id = 124
+        db.session.add(L)
+
+        for i in range(3):
+            db.session.add(Recommendation(id=500 + i, title=f"Taco stand {i}", content="Al pastor",
+                                          business_name="Tacos", business_address="1 Pine Ave",
+                                          business_city="Long Beach", business_state="CA",
+                                          business_country="US", business_rating=3 + i, user_id=self.u2id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+                sess[CURR_LOCATION] = 124
+
+            resp = c.post("/dateMeet/api/recommendations/500/like")
+            self.assertEqual(resp.json["count"], 1)
+
+            resp = c.get("/dateMeet/api/recommendations?sort=popular")
+            recommendations = resp.json["recommendations"]
+            self.assertEqual([r["id"] for r in recommendations], [500, 502, 501])
+            self.assertEqual(recommendations[0]["likes_count"], 1)
+
+            resp = c.get("/dateMeet/api/recommendations?sort=rating")
+            self.assertEqual([r["id"] for r in resp.json["recommendations"]], [502, 501, 500])
+
+            resp = c.get("/recommendations/list")
+            self.assertIn('btn-primary', str(resp.data))
+
+            resp = c.get("/dateMeet/api/recommendations?sort=sideways")
+            self.assertEqual(resp.status_code, 400)
+
+            # A cursor only works with the sort order it came from.
+            with mock.patch("app.FEED_PAGE_SIZE", 1):
+                cursor = c.get("/dateMeet/api/recommendations?sort=popular").json["next_cursor"]
+
+                resp = c.get("/dateMeet/api/recommendations", query_string={"sort": "popular", "before": cursor})
+                self.assertEqual(resp.status_code, 200)
+
+                resp = c.get("/dateMeet/api/recommendations", query_string={"sort": "newest", "before": cursor})
+                self.assertEqual(resp.status_code, 400)
+
+    def test_recommendation_cards_cached_by_version(self):
+        """This test method confirms that rendered recommendation cards are reused
+           until the recommendation or its author is edited.
+        """
+
+        L = Location(name="Home", address="False Test Creek SW, Long Beach CA", long=143.12, lat=-234.5,
+                     city="Long Beach", state="CA", user_id=self.testuser_id)
+        L.id = 124
+        db.session.add(L)
+        db.session.add(Recommendation(id=600, title="Fish tacos", content="Crispy",
+                                      business_name="Tacos", business_address="1 Pine Ave",
+                                      business_city="Long Beach", business_state="CA",
+                                      business_country="US", business_rating=4, user_id=self.u2id))
+        db.session.commit()
+
+        fragments = app.jinja_env.fragment_cache
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+                sess[CURR_LOCATION] = 124
+
+            c.get("/recommendations/list")
+            resp = c.get("/recommendations/list")
+            self.assertIn("Fish tacos", str(resp.data))
+            self.assertEqual(fragments.hits, 1)
+
+            rec = Recommendation.query.get(600)
+            rec.title = "Shrimp tacos"
+            rec.likes_count = 7
+            db.session.commit()
+            self.assertEqual(rec.version, 2)
+
+            resp = c.get("/recommendations/list")
+            self.assertIn("Shrimp tacos", str(resp.data))
+
+            u2 = User.query.get(self.u2id)
+            u2.username = "tacofan"
+            db.session.commit()
+            self.assertEqual(u2.version, 2)
+
+            resp = c.get("/recommendations/list")
+            self.assertIn("@tacofan", str(resp.data))
+
+    def test_show_recommendation_not_modified(self):
+        """This test method confirms that a recommendation page is answered with
+           304 Not Modified until the recommendation changes.
+        """
+
+        db.session.add(Recommendation(id=700, title="Fish tacos", content="Crispy",
+                                      business_name="Tacos", business_address="1 Pine Ave",
+                                      business_city="Long Beach", business_state="CA",
+                                      business_country="US", business_rating=4, user_id=self.u2id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/recommendations/700")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+            etag = resp.headers["ETag"]
+
+            resp = c.get("/recommendations/700", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            rec = Recommendation.query.get(700)
+            rec.content = "Crispy and cheap"
+            db.session.commit()
+
+            resp = c.get("/recommendations/700", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Crispy and cheap", str(resp.data))
+
+    def test_show_recommendation_compressed(self):
+        """This test method confirms that pages are gzipped for browsers that accept it."""
+
+        db.session.add(Recommendation(id=800, title="Fish tacos", content="Crispy",
+                                      business_name="Tacos", business_address="1 Pine Ave",
+                                      business_city="Long Beach", business_state="CA",
+                                      business_country="US", business_rating=4, user_id=self.u2id))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/recommendations/800", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", resp.headers["Vary"])
+            self.assertIn("Fish tacos", gzip.decompress(resp.data).decode())
+
+            resp = c.get("/recommendations/800", headers={"Accept-Encoding": "gzip",
+                                                          "If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 304)
+
+            resp = c.get("/recommendations/800")
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertIn("Fish tacos", str(resp.data))
@@ -6,10 +6,11 @@
 
 
 import os
-from unittest import TestCase
+from unittest import TestCase, mock
 from sqlalchemy import exc
 
 from models import db, User, Recommendation, Follows, Location
+from passwords import bcrypt
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,7 +22,9 @@ os.environ['DATABASE_URL'] = "postgresql:///dateMeet_test"
 
 # Now we can import app
 
-from app import app
+from app import create_app
+
+app = create_app('test')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -115,7 +118,7 @@ class UserModelTestCase(TestCase):
     def test_user_follows(self):
         """This test method checks to see if user1 is following user 2"""
 
-        self.user1.following.append(self.user2)
+        db.session.add(Follows(user_following_id=self.u1d1, user_being_followed_id=self.u2d2))
         db.session.commit()
 
         self.assertEqual(len(self.user1.following), 1)
@@ -129,12 +132,49 @@ class UserModelTestCase(TestCase):
     def test_user_following(self):
         """This test method checks that the is_following method works"""
 
-        self.user1.following.append(self.user2)
+        db.session.add(Follows(user_following_id=self.u1d1, user_being_followed_id=self.u2d2))
         db.session.commit()
 
         self.assertTrue(self.user1.is_following(self.user2))
         self.assertFalse(self.user2.is_following(self.user1))
 
+    def test_following_ids_among(self):
+        """This test method checks the batched follow state lookup"""
+
+        user3 = User.register("User", "Three", "user3@test.com", "user3", "passWord4u3", None, None)
+        user3.id = 3333
+        db.session.commit()
+
+        db.session.add(Follows(user_following_id=self.u1d1, user_being_followed_id=self.u2d2))
+        db.session.commit()
+
+        self.assertEqual(self.user1.following_ids_among([self.u2d2, 3333]), {self.u2d2})
+        self.assertEqual(self.user2.follower_ids_among([self.u1d1, 3333]), {self.u1d1})
+        self.assertEqual(self.user1.following_ids_among([]), set())
+        self.assertTrue(self.user2.is_followed_by(self.user1))
+
+    def test_follows_pulled_past_fanout_limit(self):
+        """This test method checks that the follows of an author are marked pulled while
+           the author has more than FANOUT_MAX_FOLLOWERS followers
+        """
+
+        user3 = User.register("User", "Three", "user3@test.com", "user3", "passWord4u3", None, None)
+        user3.id = 3333
+        db.session.commit()
+
+        with mock.patch("models.FANOUT_MAX_FOLLOWERS", 1):
+            db.session.add(Follows(user_following_id=self.u1d1, user_being_followed_id=self.u2d2))
+            db.session.commit()
+            self.assertEqual(Follows.query.filter_by(pulled=True).count(), 0)
+
+            db.session.add(Follows(user_following_id=3333, user_being_followed_id=self.u2d2))
+            db.session.commit()
+            self.assertEqual(Follows.query.filter_by(pulled=True).count(), 2)
+
+            db.session.delete(Follows.query.filter_by(user_following_id=3333).one())
+            db.session.commit()
+            self.assertEqual(Follows.query.filter_by(pulled=True).count(), 0)
+
     #######################
     #
     # Signup Tests
@@ -162,6 +202,26 @@ class UserModelTestCase(TestCase):
         self.assertTrue(test_user.password.startswith("$2b$"))
 
 
+    def test_authenticate_rehashes_password(self):
+        """This test method tests that logging in upgrades a password hashed
+           with an older work factor.
+        """
+
+        # The test profile hashes with a work factor of 4, so seed an older, costlier hash.
+        self.user1.password = bcrypt.generate_password_hash("passWord4u1", 5).decode('UTF-8')
+        db.session.commit()
+        self.assertTrue(User.query.get(self.u1d1).password.startswith("$2b$05$"))
+
+        user = User.authenticate("user1", "passWord4u1")
+        db.session.commit()
+
+        password_hash = User.query.get(self.u1d1).password
+        self.assertTrue(password_hash.startswith(f"$2b$0{app.config['BCRYPT_LOG_ROUNDS']}$"))
+        self.assertTrue(bcrypt.check_password_hash(password_hash, "passWord4u1"))
+
+        self.assertEqual(User.authenticate("user1", "passWord4u1"), user)
+        self.assertFalse(User.authenticate("user1", "wrong password"))
+
     def test_user_existing_username(self):
         """This test method tests for an existing user name"""
 
@@ -204,4 +264,41 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(User.authenticate(self.user1.username, "badpassWord4u1"))
 
-    
\ No newline at end of file
+    ###############################
+    #
+    # Counter tests
+    #
+    ##############################
+
+    def test_user_counters(self):
+        """This test method checks that follows and recommendations update the user counters"""
+
+        db.session.add(Follows(user_following_id=self.u1d1, user_being_followed_id=self.u2d2))
+        db.session.add(Recommendation(title="Burgers", content="Best burgers in town", business_name="Marcos",
+                                      business_address="13425 36 Ave NW", business_city="Edmonton",
+                                      business_state="Alberta", business_country="Canada",
+                                      business_rating=4, user_id=self.u2d2))
+        db.session.commit()
+
+        user1 = User.query.get(self.u1d1)
+        user2 = User.query.get(self.u2d2)
+
+        self.assertEqual(user1.following_count, 1)
+        self.assertEqual(user2.followers_count, 1)
+        self.assertEqual(user2.recommendation_count, 1)
+
+    def test_reconcile_counters(self):
+        """This test method checks that drifted counters are repaired"""
+
+        db.session.add(Follows(user_following_id=self.u1d1, user_being_followed_id=self.u2d2))
+        db.session.commit()
+
+        User.query.filter(User.id == self.u2d2).update({"followers_count": 42, "likes_count": 3})
+        db.session.commit()
+
+        self.assertEqual(User.reconcile_counters(), 1)
+        db.session.commit()
+
+        user2 = User.query.get(self.u2d2)
+        self.assertEqual(user2.followers_count, 1)
+        self.assertEqual(user2.likes_count, 0)
@@ -6,10 +6,12 @@
 
 
 import os
-from unittest import TestCase
+from io import BytesIO
+from unittest import TestCase, mock
 
 from models import db, connect_db, User, Recommendation, Location, Likes, Follows
 from bs4 import BeautifulSoup
+from PIL import Image
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests 
@@ -19,7 +21,11 @@ os.environ['DATABASE_URL'] = "postgresql:///dateMeet_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY, CURR_LOCATION
+from app import create_app, CURR_USER_KEY, CURR_LOCATION, current_user_cache
+from query_stats import QueryBudgetMixin
+from images import IMAGE_SIZES, resized_image_url
+
+app = create_app('test')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -32,13 +38,15 @@ db.create_all()
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class UserViewsTestCase(TestCase):
+class UserViewsTestCase(QueryBudgetMixin, TestCase):
     """Test views for users."""
 
     def setUp(self):
         """Create test client, add sample data."""
         db.drop_all()
         db.create_all()
+        # Ids and versions start over with every test, so cached cards would be stale.
+        app.jinja_env.fragment_cache.clear()
     
         self.client = app.test_client()
 
@@ -150,6 +158,45 @@ class UserViewsTestCase(TestCase):
             self.assertNotIn("three", str(resp.data))
             self.assertNotIn("four", str(resp.data))
 
+    def test_users_search_pages(self):
+        """This test method confirms that user search results are paginated
+           and that the next page picks up where the first one stopped.
+        """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with mock.patch("app.USERS_PAGE_SIZE", 2):
+                first = c.get("/dateMeet/api/users/search?q=testuser").json
+                second = c.get(f"/dateMeet/api/users/search?q=testuser&before={first['next_cursor']}").json
+
+            usernames = [user["username"] for user in first["users"] + second["users"]]
+
+            self.assertEqual(len(first["users"]), 2)
+            self.assertEqual(sorted(usernames), ["testuser", "testuser1", "testuser2"])
+            self.assertIsNone(second["next_cursor"])
+
+            resp = c.get("/users?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_users_typeahead(self):
+        """This test method confirms that the typeahead endpoint returns 
+           the users whose username starts with the typed prefix.
+        """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/dateMeet/api/users/typeahead?q=TestUser")
+            usernames = [user["username"] for user in resp.json["users"]]
+
+            self.assertEqual(usernames, ["testuser", "testuser1", "testuser2"])
+
+            resp = c.get("/dateMeet/api/users/typeahead?q=t_")
+            self.assertEqual(resp.json["users"], [])
+
     def test_users_show_location(self):
         """This test method will confirm that a 
             logged in user location is displayed 
@@ -312,6 +359,30 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(len(likes), 0)
     
 
+    def test_toggle_like_api(self):
+        """This test method checks that the JSON like endpoint toggles 
+           a like and returns the new state and count.
+        """
+        self.setup_recommendations_and_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post("/dateMeet/api/recommendations/365/like")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"recommendation_id": 365, "liked": False, "count": 0})
+            self.assertEqual(User.query.get(self.testuser_id).likes_count, 0)
+
+            resp = c.post("/dateMeet/api/recommendations/365/like")
+            self.assertEqual(resp.json, {"recommendation_id": 365, "liked": True, "count": 1})
+            self.assertEqual(User.query.get(self.testuser_id).likes_count, 1)
+
+            # Users still cannot like their own recommendations
+            own = Recommendation.query.filter(Recommendation.user_id == self.testuser_id).first()
+            resp = c.post(f"/dateMeet/api/recommendations/{own.id}/like")
+            self.assertEqual(resp.status_code, 403)
+
     def setup_followers(self):
         """This is a helper method used to set up followers
             to be used in the next few test methods.
@@ -394,5 +465,211 @@ class UserViewsTestCase(TestCase):
             self.assertNotIn("@three", str(resp.data))
             self.assertNotIn("@four", str(resp.data))
 
-    
-    
+    def test_users_index_query_budget(self):
+        """This test method confirms that listing users runs a fixed number
+           of queries, no matter how many user cards are rendered.
+        """
+
+        self.setup_followers()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with self.assertMaxQueries(6):
+                resp = c.get("/users")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("db;dur=", resp.headers["Server-Timing"])
+
+    def test_follow_unfollow_counters(self):
+        """This test method confirms that following and unfollowing a user
+           keeps the following and followers counters up to date.
+        """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.u1id}")
+            c.post(f"/users/follow/{self.u1id}")
+
+            self.assertEqual(User.query.get(self.testuser_id).following_count, 1)
+            self.assertEqual(User.query.get(self.u1id).followers_count, 1)
+
+            c.post(f"/users/unfollow/{self.u1id}")
+
+            self.assertEqual(User.query.get(self.testuser_id).following_count, 0)
+            self.assertEqual(User.query.get(self.u1id).followers_count, 0)
+
+    def test_following_pages(self):
+        """This test method confirms that the following list is paginated
+           and that the HTML page stays within a fixed query budget.
+        """
+
+        self.setup_followers()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with mock.patch("app.SOCIAL_PAGE_SIZE", 1):
+                first = c.get(f"/dateMeet/api/users/{self.testuser_id}/following").json
+                second = c.get(f"/dateMeet/api/users/{self.testuser_id}/following?before={first['next_cursor']}").json
+
+            self.assertEqual([user["id"] for user in first["users"] + second["users"]], [self.u2id, self.u1id])
+            self.assertIsNone(second["next_cursor"])
+
+            with self.assertMaxQueries(6):
+                resp = c.get(f"/users/{self.testuser_id}/following")
+
+            self.assertIn("@testuser1", str(resp.data))
+            self.assertIn("@testuser2", str(resp.data))
+
+    def test_current_user_cache(self):
+        """This test method confirms that the optional current user cache
+           serves the logged in user and is cleared when the profile is edited.
+        """
+
+        with mock.patch.dict(app.config, {"CURRENT_USER_CACHE_TTL": 60}), self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/users")
+            self.assertIsNotNone(current_user_cache.get(self.testuser_id))
+            self.assertNotIn("password", current_user_cache.get(self.testuser_id))
+
+            # The logged in user comes from the cache, so this page runs no queries
+            with self.assertMaxQueries(0):
+                resp = c.get("/users/datelocations")
+
+            self.assertEqual(resp.status_code, 200)
+
+            resp = c.post("/users/edit", data={"first_name": "Test", "last_name": "User",
+                                               "username": "testuser", "email": "test@test.com",
+                                               "password": "testuser"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNone(current_user_cache.get(self.testuser_id))
+
+            # Following changes the follow counters, so it clears the cache too
+            c.get("/users")
+            self.assertIsNotNone(current_user_cache.get(self.testuser_id))
+
+            resp = c.post(f"/users/follow/{self.u1id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNone(current_user_cache.get(self.testuser_id))
+
+            # So does deleting a recommendation, which changes recommendation_count
+            recommendation = Recommendation(title="Old spot", content="Closed now", business_name="Gone",
+                                            business_address="1 Main St", business_city="Edmonton",
+                                            business_state="AB", business_country="CA", business_rating=3,
+                                            user_id=self.testuser_id)
+            db.session.add(recommendation)
+            db.session.commit()
+
+            c.get("/users")
+            self.assertIsNotNone(current_user_cache.get(self.testuser_id))
+
+            resp = c.post(f"/recommendations/{recommendation.id}/delete")
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNone(current_user_cache.get(self.testuser_id))
+
+    def test_homepage_current_location(self):
+        """This test method confirms that the homepage sends users with a location
+           to their current location, and sets the pointer for users who don't have one yet.
+        """
+
+        old = Location(name="Old", address="1 Old St, Edmonton AB", long=-113.5, lat=53.5,
+                       city="Edmonton", state="AB", user_id=self.testuser_id)
+        new = Location(name="New", address="2 New St, Edmonton AB", long=-113.4, lat=53.6,
+                       city="Edmonton", state="AB", user_id=self.testuser_id)
+        db.session.add_all([old, new])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.get(self.testuser_id).current_location_id, new.id)
+
+            User.query.get(self.testuser_id).current_location_id = old.id
+            db.session.commit()
+
+            with self.assertMaxQueries(1):
+                resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 302)
+            with c.session_transaction() as sess:
+                self.assertEqual(sess[CURR_LOCATION], old.id)
+
+    def test_homepage_without_location(self):
+        """This test method confirms that the latest location of a user who has none is
+           only looked up on their first visit to the homepage.
+        """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1id
+
+            resp = c.get("/")
+            self.assertEqual(resp.status_code, 200)
+
+            # Only the logged in user is loaded this time
+            with self.assertMaxQueries(1):
+                resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+
+    def test_resized_images(self):
+        """This test method confirms that avatars are served resized through the image proxy."""
+
+        with app.test_request_context():
+            url = resized_image_url("/static/blank-profile-picture.png", "avatar")
+
+        resp = self.client.get(url, headers={"Accept": "image/webp,*/*"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "image/webp")
+        self.assertEqual(Image.open(BytesIO(resp.data)).size, IMAGE_SIZES["avatar"])
+
+        resp = self.client.get(url, headers={"Accept": "*/*"})
+        self.assertEqual(resp.mimetype, "image/jpeg")
+
+        resp = self.client.get(url.replace("/avatar/", "/huge/"))
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get(url[:-3])
+        self.assertEqual(resp.status_code, 404)
+
+        User.query.get(self.testuser_id).image_url = "/static/blank-profile-picture.png"
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/users/{self.testuser_id}")
+            self.assertIn("/images/profile/", str(resp.data))
+
+    def test_resized_image_sources_checked(self):
+        """This test method confirms that the image proxy checks every redirect of a
+           source image and drops sources that are too large.
+        """
+
+        redirect = mock.Mock(status_code=302, is_redirect=True, headers={"Location": "http://internal/a.png"})
+        huge = mock.Mock(status_code=200, is_redirect=False, headers={"Content-Length": str(10 ** 9)})
+
+        with app.test_request_context():
+            url = resized_image_url("https://example.com/a.png", "avatar")
+
+        with mock.patch("images.is_public_host", side_effect=lambda host: host != "internal"), \
+                mock.patch("images.image_client.get", side_effect=[redirect, huge]) as get:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn("blank-profile-picture", resp.location)
+            self.assertEqual(get.call_count, 1)
+
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 302)
+            huge.iter_content.assert_not_called()